@@ -1,3 +1,4 @@
-from .metrics import DatasetMetrics, DiffMetrics
-from .plot import plot
-from .util import open_datasets, print_stats
+from .cache import MetricCache, set_cache
+from .metrics import DatasetMetrics, DiffMetrics, StreamingMetrics, compute_metrics
+from .plot import plot, plot_grid, render_plots
+from .util import ComputeCounter, compare_all, open_datasets, print_stats
@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import time
+from typing import Optional, Union
+
+import dask
+import xarray as xr
+
+_default_cache = None
+
+
+class MetricCache(object):
+    """
+    This class stores computed metrics as netCDF files in a local directory, so they can be reused across
+    sessions. Entries are keyed by a fingerprint of the input data, the aggregate dimensions, the metric name and
+    its parameters. For data opened from files, the fingerprint identifies the files, their modification times,
+    the variable and any subsetting applied to it, and for in-memory data it is a checksum of the values. When the
+    directory grows beyond max_size bytes, the least recently used entries are removed.
+    """
+
+    def __init__(self, directory: str, max_size: int = 2 ** 30):
+        self._directory = directory
+        self._max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def directory(self) -> str:
+        return self._directory
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size
+
+    def key(
+        self, ds: Union[xr.DataArray, str], aggregate_dims: Optional[list], name: str, **params
+    ) -> str:
+        """
+        The cache key of a metric
+
+        Parameters:
+        ===========
+        ds -- xarray.DataArray or string
+            the data the metric is computed on, or its dask token (from dask.base.tokenize), which saves hashing
+            in-memory data again for every metric
+        aggregate_dims -- list <string>
+            the dimensions the metric is aggregated across
+        name -- string
+            the name of the metric
+
+        **params -- any parameters the metric depends on (e.g. the quantile)
+
+        Returns
+        =======
+        out -- string
+        """
+        description = json.dumps(
+            [ds if isinstance(ds, str) else dask.base.tokenize(ds), aggregate_dims, name, params],
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._directory, f'{key}.nc')
+
+    def get(self, key: str) -> Optional[xr.DataArray]:
+        """
+        Gets a cached metric, or None if the metric is not in the cache
+        """
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            metric = xr.load_dataarray(path)
+        except (OSError, ValueError):
+            # an entry that cannot be read is treated as missing and overwritten by the next put
+            return None
+        self._touch(path)
+        return metric
+
+    def put(self, key: str, metric: xr.DataArray) -> None:
+        """
+        Stores a computed metric in the cache, evicting the least recently used entries if needed
+        """
+        path = self._path(key)
+        # write to a temporary file first so readers never see a partially written entry
+        metric.to_netcdf(f'{path}.tmp')
+        os.replace(f'{path}.tmp', path)
+        self._touch(path)
+        self._evict()
+
+    def clear(self) -> None:
+        """
+        Removes every entry from the cache, with any temporary file left by an interrupted put
+        """
+        for filename in os.listdir(self._directory):
+            if filename.endswith('.nc') or filename.endswith('.nc.tmp'):
+                os.remove(os.path.join(self._directory, filename))
+
+    def _touch(self, path: str) -> None:
+        # mark the entry as recently used, with a finer timestamp than the file system clock gives
+        # (time.time_ns is not available before Python 3.7)
+        now = time.time_ns() if hasattr(time, 'time_ns') else int(time.time() * 1e9)
+        os.utime(path, ns=(now, now))
+
+    def _evict(self) -> None:
+        entries = []
+        for filename in os.listdir(self._directory):
+            if filename.endswith('.nc'):
+                stat = os.stat(os.path.join(self._directory, filename))
+                entries.append((stat.st_mtime_ns, stat.st_size, filename))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, filename in sorted(entries):
+            if total_size <= self._max_size:
+                break
+            os.remove(os.path.join(self._directory, filename))
+            total_size -= size
+
+
+def set_cache(directory: Optional[str], max_size: int = 2 ** 30) -> Optional[MetricCache]:
+    """
+    Sets the metric cache used by default by every DatasetMetrics object
+
+    Parameters:
+    ===========
+    directory -- string
+        the directory to store the cached metrics in, or None to stop caching metrics by default
+
+    Keyword Arguments:
+    ==================
+    max_size -- int (default 2**30)
+        the size in bytes above which the least recently used metrics are removed from the cache
+
+    Returns
+    =======
+    out -- MetricCache
+        the new default cache
+    """
+    global _default_cache
+    _default_cache = None if directory is None else MetricCache(directory, max_size)
+    return _default_cache
+
+
+def get_cache() -> Optional[MetricCache]:
+    """
+    Gets the metric cache used by default by every DatasetMetrics object (None if metrics are not cached)
+    """
+    return _default_cache
@@ -1,25 +1,625 @@
+import warnings
 from typing import Optional
 
+import dask
+import dask.array as da
 import numpy as np
 import xarray as xr
+from scipy import special
 from scipy import stats as ss
+from scipy.spatial import cKDTree
+
+from .cache import MetricCache, get_cache
+
+# Fields of the fused moment reduction. 'm2' is the sum of squared deviations from the mean,
+# merged across partial results with Chan's parallel update so it stays numerically stable.
+_MOMENT_FIELDS = (
+    'n',
+    'sum',
+    'm2',
+    'sum_abs',
+    'sum_sq',
+    'max',
+    'min',
+    'max_abs',
+    'min_abs',
+    'n_pos',
+    'n_neg',
+)
+_MOMENT_DTYPE = np.dtype([(field, np.float64) for field in _MOMENT_FIELDS])
+# Fields added to the fused reduction with weights: the sums of the weights (of the points that are not NaN, and of
+# every point), the weighted sums, the weighted 'm2' and the weights of the positive and negative points
+_WEIGHTED_MOMENT_FIELDS = (
+    'w',
+    'w_all',
+    'w_sum',
+    'w_sum_abs',
+    'w_sum_sq',
+    'w_m2',
+    'w_pos',
+    'w_neg',
+)
+_WEIGHTED_MOMENT_DTYPE = np.dtype(
+    [(field, np.float64) for field in _MOMENT_FIELDS + _WEIGHTED_MOMENT_FIELDS]
+)
+
+
+def _squeeze_axes(moments, axis, keepdims):
+    if keepdims:
+        return moments
+    return np.squeeze(moments, axis=axis)
+
+
+def _moments_chunk(x, weights=None, axis=None, keepdims=True, **kwargs):
+    """
+    Compute every partial moment of a single block of data along axis in one pass, with the weighted moments if
+    weights (broadcastable to the block) are given
+    """
+    # reductions are accumulated in float64 whatever the precision of the data itself
+    x = np.asarray(x)
+    axis = tuple(range(x.ndim)) if axis is None else axis
+    abs_x = np.abs(x)
+
+    n = np.sum(~np.isnan(x), axis=axis, keepdims=True)
+    moments = np.empty(n.shape, dtype=_MOMENT_DTYPE if weights is None else _WEIGHTED_MOMENT_DTYPE)
+    moments['n'] = n
+    moments['sum'] = np.nansum(x, axis=axis, keepdims=True, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        block_mean = moments['sum'] / n
+    moments['m2'] = np.nansum(np.square(x - block_mean), axis=axis, keepdims=True)
+    moments['sum_abs'] = np.nansum(abs_x, axis=axis, keepdims=True, dtype=np.float64)
+    moments['sum_sq'] = np.nansum(
+        np.square(x, dtype=np.float64), axis=axis, keepdims=True, dtype=np.float64
+    )
+    moments['max'] = np.fmax.reduce(x, axis=axis, keepdims=True)
+    moments['min'] = np.fmin.reduce(x, axis=axis, keepdims=True)
+    moments['max_abs'] = np.fmax.reduce(abs_x, axis=axis, keepdims=True)
+    moments['min_abs'] = np.fmin.reduce(abs_x, axis=axis, keepdims=True)
+    moments['n_pos'] = np.sum(x > 0, axis=axis, keepdims=True)
+    moments['n_neg'] = np.sum(x < 0, axis=axis, keepdims=True)
+
+    if weights is not None:
+        w = np.broadcast_to(np.asarray(weights, dtype=np.float64), x.shape)
+        moments['w'] = np.sum(np.where(np.isnan(x), 0.0, w), axis=axis, keepdims=True)
+        moments['w_all'] = np.sum(w, axis=axis, keepdims=True)
+        moments['w_sum'] = np.nansum(w * x, axis=axis, keepdims=True)
+        moments['w_sum_abs'] = np.nansum(w * abs_x, axis=axis, keepdims=True)
+        moments['w_sum_sq'] = np.nansum(
+            w * np.square(x, dtype=np.float64), axis=axis, keepdims=True
+        )
+        with np.errstate(divide='ignore', invalid='ignore'):
+            block_mean = moments['w_sum'] / moments['w']
+        moments['w_m2'] = np.nansum(w * np.square(x - block_mean), axis=axis, keepdims=True)
+        moments['w_pos'] = np.sum(np.where(x > 0, w, 0.0), axis=axis, keepdims=True)
+        moments['w_neg'] = np.sum(np.where(x < 0, w, 0.0), axis=axis, keepdims=True)
+
+    return _squeeze_axes(moments, axis, keepdims)
+
+
+def _moments_combine(parts, axis=None, keepdims=True, **kwargs):
+    """
+    Merge partial moments (concatenated along axis) into a single set of moments
+    """
+    axis = tuple(range(parts.ndim)) if axis is None else axis
+    n_parts = parts['n']
+
+    n = np.sum(n_parts, axis=axis, keepdims=True)
+    moments = np.empty(n.shape, dtype=parts.dtype)
+    moments['n'] = n
+    moments['sum'] = np.sum(parts['sum'], axis=axis, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        delta = np.where(n_parts > 0, parts['sum'] / n_parts - moments['sum'] / n, 0.0)
+    moments['m2'] = np.sum(parts['m2'] + n_parts * np.square(delta), axis=axis, keepdims=True)
+    for field in ('sum_abs', 'sum_sq', 'n_pos', 'n_neg'):
+        moments[field] = np.sum(parts[field], axis=axis, keepdims=True)
+    for field in ('max', 'max_abs'):
+        moments[field] = np.fmax.reduce(parts[field], axis=axis, keepdims=True)
+    for field in ('min', 'min_abs'):
+        moments[field] = np.fmin.reduce(parts[field], axis=axis, keepdims=True)
+
+    if 'w' in parts.dtype.names:
+        w_parts = parts['w']
+        for field in ('w', 'w_all', 'w_sum', 'w_sum_abs', 'w_sum_sq', 'w_pos', 'w_neg'):
+            moments[field] = np.sum(parts[field], axis=axis, keepdims=True)
+        # Chan's update with each part weighted by the sum of its weights
+        with np.errstate(divide='ignore', invalid='ignore'):
+            delta = np.where(
+                w_parts > 0, parts['w_sum'] / w_parts - moments['w_sum'] / moments['w'], 0.0
+            )
+        moments['w_m2'] = np.sum(
+            parts['w_m2'] + w_parts * np.square(delta), axis=axis, keepdims=True
+        )
+
+    return _squeeze_axes(moments, axis, keepdims)
+
+
+def _moments(data, axis, weights=None):
+    """
+    The fused moments of data along axis, as a (possibly lazy) structured array, with the weighted moments if
+    weights (with the dimensions of the data, where they may have length 1) are given
+    """
+    if weights is not None:
+        if not isinstance(data, da.Array):
+            return _moments_chunk(data, weights, axis=axis, keepdims=False)
+        # the moments of each block (with the weights of that block), merged like those of any reduction
+        weights = da.asarray(weights)
+        weights = weights.rechunk(
+            tuple(chunks if size > 1 else (1,) for size, chunks in zip(weights.shape, data.chunks))
+        )
+        parts = da.map_blocks(
+            _moments_chunk,
+            data,
+            weights,
+            axis=axis,
+            keepdims=True,
+            chunks=tuple(
+                (1,) * len(chunks) if i in axis else chunks for i, chunks in enumerate(data.chunks)
+            ),
+            dtype=_WEIGHTED_MOMENT_DTYPE,
+            meta=np.empty((0,) * data.ndim, dtype=_WEIGHTED_MOMENT_DTYPE),
+        )
+        return da.reduction(
+            parts,
+            _moments_combine,
+            _moments_combine,
+            combine=_moments_combine,
+            axis=axis,
+            keepdims=False,
+            dtype=_WEIGHTED_MOMENT_DTYPE,
+            concatenate=True,
+            meta=np.empty((0,) * (data.ndim - len(axis)), dtype=_WEIGHTED_MOMENT_DTYPE),
+        )
+
+    if isinstance(data, da.Array):
+        return da.reduction(
+            data,
+            _moments_chunk,
+            _moments_combine,
+            combine=_moments_combine,
+            axis=axis,
+            keepdims=False,
+            dtype=_MOMENT_DTYPE,
+            concatenate=True,
+            meta=np.empty((0,) * (data.ndim - len(axis)), dtype=_MOMENT_DTYPE),
+        )
+    return _moments_chunk(data, axis=axis, keepdims=False)
+
+
+def _as_float64(ds):
+    """
+    The data as float64 (lazily for dask-backed data), without copying data that is already float64
+    """
+    return ds if ds.dtype == np.float64 else ds.astype(np.float64)
+
+
+def _square_sums(da, dim=None, weights=None):
+    """
+    The sum of the squares of da along dim (weighted, if weights are given) and the count (or the sum of the
+    weights) of the values that are not NaN. The squares are summed in float64 by einsum without being stored,
+    so the only temporary the size of da is its copy with the NaNs zeroed, in the precision of da.
+    """
+    dim = list(da.dims) if dim is None else [dim] if isinstance(dim, str) else list(dim)
+    valid = da.notnull()
+    filled = da.fillna(0)
+    if weights is None:
+        return xr.dot(filled, filled, dim=dim, dtype=np.float64), valid.sum(dim)
+    squares = xr.dot(filled, filled, weights, dim=dim, dtype=np.float64)
+    return squares, xr.dot(valid, weights, dim=dim)
+
+
+def _lag_products_kernel(x, max_lag=1):
+    """
+    The sums along the last axis of the products of x with itself 0 to max_lag steps later (NaNs count as zero),
+    summed in float64 along a new last axis. Every lag is computed from the same slices of the block, which are
+    views.
+    """
+    x = np.where(np.isnan(x), 0, x)
+    n = x.shape[-1]
+    products = np.zeros(x.shape[:-1] + (max_lag + 1,), dtype=np.float64)
+    for lag in range(min(max_lag, n - 1) + 1):
+        products[..., lag] = np.einsum(
+            '...i,...i->...', x[..., : n - lag], x[..., lag:], dtype=np.float64
+        )
+    return products
+
+
+def _ks_statistic_kernel(x, y, n_core_dims=1):
+    """
+    The two-sample Kolmogorov-Smirnov statistic over the last n_core_dims axes of x and y (NaNs are ignored)
+    """
+    x = np.reshape(x, x.shape[: x.ndim - n_core_dims] + (-1,))
+    y = np.reshape(y, y.shape[: y.ndim - n_core_dims] + (-1,))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        step_x = 1 / np.sum(~np.isnan(x), axis=-1, keepdims=True)
+        step_y = -1 / np.sum(~np.isnan(y), axis=-1, keepdims=True)
+
+    # walking through the pooled sorted values, each value of x raises F_x - F_y by 1/n_x and each
+    # value of y lowers it by 1/n_y
+    values = np.concatenate([x, y], axis=-1)
+    steps = np.concatenate([np.broadcast_to(step_x, x.shape), np.broadcast_to(step_y, y.shape)], -1)
+    steps = np.where(np.isnan(values), 0.0, steps)
+    order = np.argsort(values, axis=-1, kind='stable')
+    values = np.take_along_axis(values, order, axis=-1)
+    cdf_diff = np.cumsum(np.take_along_axis(steps, order, axis=-1), axis=-1)
+
+    # the difference is only attained after the last of a run of tied values
+    last_of_ties = np.ones(values.shape, dtype=bool)
+    last_of_ties[..., :-1] = values[..., 1:] != values[..., :-1]
+    return np.max(np.where(last_of_ties, np.abs(cdf_diff), 0.0), axis=-1)
+
+
+def _in_selected_bins(block, edges, selected):
+    bins = np.searchsorted(edges, block, side='right') - 1
+    bins[block == edges[-1]] = len(edges) - 2
+    in_range = np.isfinite(block) & (bins >= 0) & (bins < len(edges) - 1)
+    return in_range & selected[np.clip(bins, 0, len(edges) - 2)]
+
+
+def _bin_stats(block, edges):
+    """
+    The number, minimum and maximum of the values of a block in each bin between edges (like numpy.histogram,
+    the last bin includes its right edge)
+    """
+    block = np.ravel(block)
+    n_bins = len(edges) - 1
+    bins = np.searchsorted(edges, block, side='right') - 1
+    bins[block == edges[-1]] = n_bins - 1
+    # NaNs and infinite values fall outside the edges
+    in_range = (bins >= 0) & (bins < n_bins)
+    bins = bins[in_range]
+    # ufunc.at only takes its fast path when the values have the dtype of the output
+    block = block[in_range].astype(np.float64)
+    mins = np.full(n_bins, np.inf)
+    maxs = np.full(n_bins, -np.inf)
+    np.minimum.at(mins, bins, block)
+    np.maximum.at(maxs, bins, block)
+    return np.bincount(bins, minlength=n_bins), mins, maxs
+
+
+def _chunked_ks_statistic(x, y, bins=4096, max_exact_values=1000000, max_refinements=8):
+    """
+    The two-sample Kolmogorov-Smirnov statistic of all the values of x and y (NaNs are ignored), computed over
+    chunks without loading or sorting the full arrays
+
+    Both empirical CDFs are evaluated at the edges of a shared histogram, which gives a lower bound on the
+    statistic. Inside a bin the distance between the CDFs can grow by at most the mass that bin holds, so only
+    bins that could exceed the lower bound are refined, and the values of those few bins are finally gathered
+    to evaluate the statistic exactly. A bin whose values are all equal (e.g. the exact zeros of precipitation)
+    is exact at its edges and never gathered. At most max_exact_values values are gathered: if the bins left
+    after max_refinements hold more, a RuntimeWarning is issued and the upper bound the histogram gives on the
+    statistic is returned instead, which may exceed the exact statistic.
+    """
+    x = da.asarray(x).ravel()
+    y = da.asarray(y).ravel()
+
+    def finite(a):
+        return da.where(da.isfinite(a), a, np.nan)
+
+    with np.errstate(invalid='ignore'):
+        n_x, n_y, neg_inf_x, neg_inf_y, lo_x, lo_y, hi_x, hi_y = dask.compute(
+            da.sum(~da.isnan(x)),
+            da.sum(~da.isnan(y)),
+            da.sum(x == -np.inf),
+            da.sum(y == -np.inf),
+            da.nanmin(finite(x)),
+            da.nanmin(finite(y)),
+            da.nanmax(finite(x)),
+            da.nanmax(finite(y)),
+        )
+    lo = np.fmin(lo_x, lo_y)
+    hi = np.fmax(hi_x, hi_y)
+    if n_x == 0 or n_y == 0:
+        return np.nan
+    if np.isnan(lo):
+        # only infinite values, which are all tied at either end
+        return abs((neg_inf_x / n_x) - (neg_inf_y / n_y))
+
+    def histograms(edges):
+        blocks_x = x.to_delayed().ravel()
+        blocks_y = y.to_delayed().ravel()
+        stats = dask.compute(
+            *[dask.delayed(_bin_stats)(block, edges) for block in [*blocks_x, *blocks_y]]
+        )
+        counts_x = np.sum([counts for counts, _, _ in stats[: len(blocks_x)]], axis=0)
+        counts_y = np.sum([counts for counts, _, _ in stats[len(blocks_x) :]], axis=0)
+        # the smallest and largest value of both samples in each bin
+        mins = np.min([bin_mins for _, bin_mins, _ in stats], axis=0)
+        maxs = np.max([bin_maxs for _, _, bin_maxs in stats], axis=0)
+        below_x = neg_inf_x + np.concatenate([[0], np.cumsum(counts_x)])
+        below_y = neg_inf_y + np.concatenate([[0], np.cumsum(counts_y)])
+        return counts_x, counts_y, below_x, below_y, mins < maxs
+
+    edges = np.linspace(lo, hi, bins + 1) if hi > lo else np.array([lo, hi])
+    for refinement in range(max_refinements + 1):
+        counts_x, counts_y, below_x, below_y, distinct = histograms(edges)
+        cdf_diff = below_x / n_x - below_y / n_y
+        statistic = np.max(np.abs(cdf_diff))
+        upper = np.fmax(
+            np.abs(cdf_diff[:-1] + counts_x / n_x), np.abs(cdf_diff[:-1] - counts_y / n_y)
+        )
+        # the CDFs only step once in a bin holding a single value, so its edges give the exact distance
+        candidates = (upper > statistic) & distinct
+        if not candidates.any():
+            return statistic
+        n_candidate_values = counts_x[candidates].sum() + counts_y[candidates].sum()
+        if n_candidate_values <= max_exact_values:
+            break
+        if refinement == max_refinements:
+            # the values that cannot be told apart are too many to gather
+            warnings.warn(
+                f'the Kolmogorov-Smirnov statistic could not be resolved in {max_refinements} '
+                f'refinements of the histogram; returning an upper bound on it',
+                RuntimeWarning,
+            )
+            return np.max(upper[candidates])
+        sub_bins = max(2, bins // int(candidates.sum()))
+        sub_edges = [
+            np.linspace(edges[i], edges[i + 1], sub_bins + 1) for i in np.flatnonzero(candidates)
+        ]
+        edges = np.unique(np.concatenate([edges] + sub_edges))
+
+    values_x, values_y = dask.compute(
+        x[x.map_blocks(_in_selected_bins, edges, candidates, dtype=bool)],
+        y[y.map_blocks(_in_selected_bins, edges, candidates, dtype=bool)],
+    )
+    values_x = np.sort(values_x)
+    values_y = np.sort(values_y)
+    points = np.union1d(values_x, values_y)
+    point_bins = np.minimum(np.searchsorted(edges, points, side='right') - 1, len(edges) - 2)
+    left_edges = edges[point_bins]
+    cdf_x = (
+        below_x[point_bins]
+        + np.searchsorted(values_x, points, side='right')
+        - np.searchsorted(values_x, left_edges, side='left')
+    ) / n_x
+    cdf_y = (
+        below_y[point_bins]
+        + np.searchsorted(values_y, points, side='right')
+        - np.searchsorted(values_y, left_edges, side='left')
+    ) / n_y
+    return max(statistic, np.max(np.abs(cdf_x - cdf_y), initial=0.0))
+
+
+def _histogram_chunk(x, lo, hi, axis, bins):
+    """
+    The histogram of a block of data along axis at each point, on bins evenly spaced between lo and hi (the
+    extrema at each point), with the counts along a new last axis
+    """
+    x = np.moveaxis(np.asarray(x), axis, range(-len(axis), 0))
+    lo = np.moveaxis(np.asarray(lo), axis, range(-len(axis), 0))
+    hi = np.moveaxis(np.asarray(hi), axis, range(-len(axis), 0))
+    point_shape = x.shape[: x.ndim - len(axis)]
+    x = x.reshape(point_shape + (-1,))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        position = (x - lo.reshape(point_shape + (1,))) / (hi - lo).reshape(point_shape + (1,))
+    index = np.clip(np.nan_to_num(position * bins, nan=0.0), 0, bins - 1).astype(np.int64)
+    # offset the bins of each point so one bincount histograms every point at once
+    index += np.arange(int(np.prod(point_shape)), dtype=np.int64).reshape(point_shape + (1,)) * bins
+    counts = np.bincount(index[~np.isnan(x)], minlength=int(np.prod(point_shape)) * bins).reshape(
+        point_shape + (bins,)
+    )
+    return np.expand_dims(counts, tuple(sorted(axis)))
+
+
+def _histogram_quantiles(counts, lo, hi, q):
+    """
+    The quantiles q at each point, estimated from the histograms in the last axis of counts, along the last axis
+
+    The values of each rank are taken to be evenly spread in their bin and interpolated between ranks like
+    numpy.quantile, so each estimate is within one bin width of the exact quantile.
+    """
+    bins = counts.shape[-1]
+    lo = np.reshape(lo, counts.shape[:-1])
+    hi = np.reshape(hi, counts.shape[:-1])
+    cumulative = np.cumsum(counts, axis=-1)
+    n = cumulative[..., -1]
+    width = (hi - lo) / bins
+
+    def rank_value(rank):
+        # the bin holding each rank, and the position of the rank among the values of that bin
+        rank_bin = np.minimum(np.sum(cumulative <= rank[..., np.newaxis], axis=-1), bins - 1)
+        in_bin = np.take_along_axis(counts, rank_bin[..., np.newaxis], axis=-1)[..., 0]
+        below = np.take_along_axis(cumulative, rank_bin[..., np.newaxis], axis=-1)[..., 0] - in_bin
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return lo + width * (rank_bin + (rank - below + 0.5) / in_bin)
+
+    quantiles = []
+    for quantile in q:
+        rank = quantile * (n - 1)
+        lower = np.floor(rank)
+        upper = np.minimum(lower + 1, np.maximum(n - 1, 0))
+        value = rank_value(lower) + (rank - lower) * (rank_value(upper) - rank_value(lower))
+        # every value of a point is its minimum when all of them are equal
+        quantiles.append(np.where(n > 0, np.where(width > 0, value, lo), np.nan))
+    return np.stack(quantiles, axis=-1)
+
+
+def _unit_vectors(lat, lon):
+    lat = np.deg2rad(lat)
+    lon = np.deg2rad(lon)
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+# Neighbor of every cell of recently used unstructured grids, keyed by a checksum of the grid and direction
+_ncol_neighbor_cache = {}
+_NCOL_NEIGHBOR_CACHE_SIZE = 8
+
+
+def _ncol_neighbors(lat, lon, dir, k=8):
+    """
+    The index of the neighbor to the north ('ns') or east ('ew') of every cell of an unstructured grid, or -1
+    for cells without one (e.g. at the poles). Among the k nearest cells, the neighbor is the nearest one whose
+    direction is within 45 degrees of north (east), or else the one whose direction is closest to north (east).
+    """
+    key = dask.base.tokenize(lat, lon, dir, k)
+    neighbors = _ncol_neighbor_cache.get(key)
+    if neighbors is not None:
+        return neighbors
+
+    points = _unit_vectors(lat, lon)
+    distances, candidates = cKDTree(points).query(points, k + 1)
+    # the first candidate is the cell itself
+    distances = distances[:, 1:]
+    candidates = candidates[:, 1:]
+
+    lat_rad = np.deg2rad(lat)[:, np.newaxis]
+    lon_rad = np.deg2rad(lon)[:, np.newaxis]
+    offsets = points[candidates] - points[:, np.newaxis, :]
+    if dir == 'ns':
+        component = (
+            -np.sin(lat_rad) * np.cos(lon_rad) * offsets[..., 0]
+            - np.sin(lat_rad) * np.sin(lon_rad) * offsets[..., 1]
+            + np.cos(lat_rad) * offsets[..., 2]
+        )
+    else:
+        component = -np.sin(lon_rad) * offsets[..., 0] + np.cos(lon_rad) * offsets[..., 1]
+    # the cosine of the angle between the direction to each candidate and north (east)
+    alignment = component / np.maximum(distances, 1e-300)
+
+    # candidates are sorted by distance, so the first one in the direction is the nearest
+    in_direction = alignment > np.sqrt(0.5)
+    best = np.where(
+        in_direction.any(axis=1), np.argmax(in_direction, axis=1), np.argmax(alignment, axis=1)
+    )
+    rows = np.arange(len(candidates))
+    neighbors = np.where(alignment[rows, best] > 0, candidates[rows, best], -1)
+
+    if len(_ncol_neighbor_cache) >= _NCOL_NEIGHBOR_CACHE_SIZE:
+        _ncol_neighbor_cache.pop(next(iter(_ncol_neighbor_cache)))
+    _ncol_neighbor_cache[key] = neighbors
+    return neighbors
+
+
+def _moment_metrics(moments, dims, coords, frame_size):
+    """
+    The metrics derived from a set of fused moments, keyed by the DatasetMetrics attribute holding each
+    """
+
+    def field(name):
+        return xr.DataArray(moments[name], dims=dims, coords=coords)
+
+    n = field('n')
+    variance = field('m2') / n
+    metrics = {
+        '_mean': field('sum') / n,
+        '_mean_abs': field('sum_abs') / n,
+        '_root_mean_squared': np.sqrt(field('sum_sq') / n),
+        '_sum': field('sum'),
+        '_std': np.sqrt(variance),
+        '_variance': variance,
+        '_prob_positive': field('n_pos') / frame_size,
+        '_prob_negative': field('n_neg') / frame_size,
+        '_max_abs': field('max_abs'),
+        '_min_abs': field('min_abs'),
+        '_max_val': field('max'),
+        '_min_val': field('min'),
+    }
+    if 'w' in moments.dtype.names:
+        # with weights, the averages are weighted averages
+        w = field('w')
+        w_all = field('w_all')
+        variance = field('w_m2') / w
+        metrics.update(
+            {
+                '_mean': field('w_sum') / w,
+                '_mean_abs': field('w_sum_abs') / w,
+                '_root_mean_squared': np.sqrt(field('w_sum_sq') / w),
+                '_std': np.sqrt(variance),
+                '_variance': variance,
+                '_prob_positive': field('w_pos') / w_all,
+                '_prob_negative': field('w_neg') / w_all,
+            }
+        )
+    return metrics
+
+
+def compute_metrics(requests: list, q: Optional[float] = 0.5) -> list:
+    """
+    Computes metrics of one or more DatasetMetrics objects together with a single dask.compute, so that work
+    shared between them is only done once. The computed values are kept by each object (and stored in its metric
+    cache), so requesting them again later does not compute them again.
+
+    Parameters:
+    ===========
+    requests -- list <(DatasetMetrics, string)>
+        the metrics to compute, as pairs of a DatasetMetrics object and the name of one of its metrics (each must
+        be a name accepted by get_metric)
+
+    Keyword Arguments:
+    ==================
+    q -- float (default 0.5)
+        the quantile to compute for requests of 'quantile'
+
+    Returns
+    =======
+    out -- list
+        the computed metrics, in the order of the requests
+    """
+    cached = {}
+    missing = {}
+    for i, (metrics, name) in enumerate(requests):
+        metric = metrics._load_cached(name, q)
+        if metric is not None:
+            cached[i] = metric
+        else:
+            missing[i] = metrics._get_metric(name, q)
+    (missing,) = dask.compute(missing)
+
+    # keep the computed values so later requests for these metrics are not computed again
+    for i, metric in missing.items():
+        metrics, name = requests[i]
+        slot = metrics._METRIC_SLOTS.get(name)
+        if slot is not None and isinstance(metric, xr.DataArray):
+            metrics.__setattr__(slot, metric)
+        metrics._store_cached(name, q, metric)
+
+    cached.update(missing)
+    return [cached[i] for i in range(len(requests))]
 
 
 class DatasetMetrics(object):
     """
     This class contains metrics for each point of a dataset after aggregating across one or more dimensions, and a method to access these metrics.
+
+    The data is either on a lat/lon grid, or on an unstructured 'ncol' grid, in which case the contrast variances
+    use the nearest neighbor of each cell, found from its 'lat' and 'lon' coordinates.
+
+    With weights (e.g. the latitude weights 'gw' or the cell areas 'area'), the averages along the aggregate
+    dimensions (mean, mean_abs, rms, std, variance, prob_positive and prob_negative) are weighted averages.
+
+    By default the data is stored as float64. With upcast=False the data keeps its own precision (e.g. float32, at
+    half the memory) and the metrics are accumulated in float64 instead.
+
+    Metrics requested through get_metric or get_metrics are stored in the given MetricCache (by default the one set
+    with ldcpy.set_cache, if any) and read back from it the next time they are requested for the same data. With a
+    cache, these metrics are computed when they are requested (so they can be written to the cache) rather than
+    returned lazily. Metrics that keep the aggregate dimensions (e.g. lag1) are as large as the data, and are not
+    cached.
     """
 
     def __init__(
-        self, ds: xr.DataArray, aggregate_dims: list,
+        self,
+        ds: xr.DataArray,
+        aggregate_dims: list,
+        upcast: bool = True,
+        cache: Optional[MetricCache] = None,
+        weights: Optional[xr.DataArray] = None,
     ):
-        self._ds = ds if (ds.dtype == np.float64) else ds.astype(np.float64)
+        self._ds = _as_float64(ds) if upcast else ds
+        # missing weights give no weight to their points
+        self._weights = None if weights is None else weights.fillna(0)
+        self._cache = cache if cache is not None else get_cache()
+        # metrics already read from or written to the cache by this object
+        self._cached_names = set()
+        # the dask tokens of the data and the weights in the cache keys
+        self._cache_tokens = None
         # For some reason, casting to float64 removes all attrs from the dataset
         self._ds.attrs = ds.attrs
 
         # array metrics
         self._ns_con_var = None
         self._ew_con_var = None
+        self._lev_con_var = None
         self._mean = None
         self._mean_abs = None
         self._std = None
@@ -30,8 +630,13 @@ class DatasetMetrics(object):
         self._mae_max = None
         self._corr_lag1 = None
         self._lag1 = None
+        self._climatology = None
+        self._deseas_resid = None
+        self._lag_product_sums = None
         self._agg_dims = aggregate_dims
         self._quantile_value = None
+        # quantile values by quantile and number of histogram bins (None if exact)
+        self._quantile_values = {}
         self._mean_squared = None
         self._root_mean_squared = None
         self._sum = None
@@ -46,37 +651,180 @@ class DatasetMetrics(object):
         self._max_val = None
 
         # single value metrics
-        self._zscore_cutoff = None
-        self._zscore_percent_significant = None
+        self._pvalues = None
+        self._fdr = 0.01
+        # z-score cutoff and percent significant by false discovery rate
+        self._fdr_significances = {}
 
         self._frame_size = 1
         if aggregate_dims is not None:
             for dim in aggregate_dims:
                 self._frame_size *= int(self._ds.sizes[dim])
 
+    # Units of every metric filled in by _fill_moments ('{}' is replaced with the dataset units)
+    _MOMENT_METRIC_UNITS = {
+        '_mean': '{}',
+        '_mean_abs': '{}',
+        '_root_mean_squared': '{}',
+        '_sum': '{}',
+        '_std': '',
+        '_variance': '{}^2',
+        '_prob_positive': '',
+        '_prob_negative': '',
+        '_max_abs': '{}',
+        '_min_abs': '{}',
+        '_max_val': '{}',
+        '_min_val': '{}',
+    }
+
+    # Memoized attribute holding each metric returned by get_metric, used to store computed results
+    _METRIC_SLOTS = {
+        'ns_con_var': '_ns_con_var',
+        'ew_con_var': '_ew_con_var',
+        'lev_con_var': '_lev_con_var',
+        'mean': '_mean',
+        'std': '_std',
+        'variance': '_variance',
+        'prob_positive': '_prob_positive',
+        'prob_negative': '_prob_negative',
+        'odds_positive': '_odds_positive',
+        'zscore': '_zscore',
+        'mean_abs': '_mean_abs',
+        'mean_squared': '_mean_squared',
+        'rms': '_root_mean_squared',
+        'sum': '_sum',
+        'sum_squared': '_sum_squared',
+        'corr_lag1': '_corr_lag1',
+        'lag1': '_lag1',
+        'max_abs': '_max_abs',
+        'min_abs': '_min_abs',
+        'max_val': '_max_val',
+        'min_val': '_min_val',
+        'range': '_dyn_range',
+    }
+
+    # Metrics that are never stored in the metric cache
+    _UNCACHED_METRICS = ['ds', 'spre_tol']
+
     def _is_memoized(self, metric_name: str) -> bool:
         return hasattr(self, metric_name) and (self.__getattribute__(metric_name) is not None)
 
-    def _con_var(self, dir, dataset) -> np.ndarray:
-        if dir == 'ns':
-            lat_length = dataset.sizes['lat']
-            o_1, o_2 = xr.align(
-                dataset.head({'lat': lat_length - 1}),
-                dataset.tail({'lat': lat_length - 1}),
-                join='override',
-            )
-        elif dir == 'ew':
-            lon_length = dataset.sizes['lon']
-            o_1, o_2 = xr.align(
-                dataset,
-                xr.concat(
-                    [dataset.tail({'lon': lon_length - 1}), dataset.head({'lon': 1})], dim='lon',
-                ),
-                join='override',
-            )
-        # con_var = xr.ufuncs.square((o_1 - o_2))
-        con_var = np.square((o_1 - o_2))
-        return con_var
+    def _cache_key(self, name: str, q: float) -> str:
+        if self._cache_tokens is None:
+            # tokenizing in-memory data hashes all of it, so it is only done once
+            weights_token = None if self._weights is None else dask.base.tokenize(self._weights)
+            self._cache_tokens = (dask.base.tokenize(self._ds), weights_token)
+        data_token, weights_token = self._cache_tokens
+
+        params = {'q': q} if name == 'quantile' else {}
+        if weights_token is not None:
+            params['weights'] = weights_token
+        return self._cache.key(data_token, self._agg_dims, name, **params)
+
+    def _load_cached(self, name: str, q: float) -> Optional[xr.DataArray]:
+        """
+        Gets a metric from the metric cache, or None if it is not cached
+        """
+        if self._cache is None or name in self._UNCACHED_METRICS:
+            return None
+        slot = self._METRIC_SLOTS.get(name)
+        if slot is not None and name in self._cached_names:
+            return self.__getattribute__(slot)
+        metric = self._cache.get(self._cache_key(name, q))
+        if metric is not None and slot is not None:
+            self.__setattr__(slot, metric)
+            self._cached_names.add(name)
+        return metric
+
+    def _store_cached(self, name: str, q: float, metric):
+        """
+        Stores a computed metric in the metric cache (and its memoized attribute), returning the metric
+        """
+        if self._cache is None or name in self._UNCACHED_METRICS:
+            return metric
+        if not isinstance(metric, xr.DataArray):
+            return metric
+        agg_dims = self._ds.dims if self._agg_dims is None else self._agg_dims
+        if set(metric.dims) & set(agg_dims):
+            # a metric that keeps the aggregate dimensions is as large as the data
+            return metric
+        metric = metric.compute()
+        self._cache.put(self._cache_key(name, q), metric)
+        slot = self._METRIC_SLOTS.get(name)
+        if slot is not None:
+            self.__setattr__(slot, metric)
+            self._cached_names.add(name)
+        return metric
+
+    def _fill_moments(self):
+        """
+        Computes the moments, extrema, absolute extrema and sign counts along the aggregate
+        dimensions in a single fused reduction, and fills every corresponding metric from it
+        (with weights, the averages are weighted averages, computed in the same reduction)
+        """
+        agg_dims = list(self._ds.dims) if self._agg_dims is None else list(self._agg_dims)
+        axis = tuple(self._ds.get_axis_num(dim) for dim in agg_dims)
+        weights = None
+        if self._weights is not None:
+            # the weights get a length 1 axis for each dimension of the data they do not have
+            weights = self._weights.reindex_like(self._ds).fillna(0)
+            weights = weights.expand_dims(
+                [dim for dim in self._ds.dims if dim not in weights.dims]
+            ).transpose(*self._ds.dims)
+            weights = weights.data
+        moments = _moments(self._ds.data, axis, weights)
+
+        dims = [dim for dim in self._ds.dims if dim not in agg_dims]
+        coords = {
+            name: coord
+            for name, coord in self._ds.coords.items()
+            if not set(coord.dims) & set(agg_dims)
+        }
+
+        metrics = _moment_metrics(moments, dims, coords, self._frame_size)
+        for metric_name, units in self._MOMENT_METRIC_UNITS.items():
+            metric = metrics[metric_name]
+            metric.attrs = self._ds.attrs
+            if hasattr(self._ds, 'units'):
+                metric.attrs['units'] = units.format(self._ds.units)
+            self.__setattr__(metric_name, metric)
+
+    def _con_var(self, dir, dataset) -> xr.DataArray:
+        """
+        The contrast variance in the given direction ('ns', 'ew' or 'lev') averaged along the aggregate
+        dimensions. Neighbors are compared through slices of the data, which are views, so no shifted copy of
+        the data is made. The differences (and their copy with the NaNs zeroed) are temporaries the size of
+        the data, in its own precision, made chunk by chunk for dask-backed data; their squares are summed in
+        float64 without being stored (see _square_sums).
+        """
+        agg_dims = list(dataset.dims) if self._agg_dims is None else list(self._agg_dims)
+
+        if 'ncol' in dataset.dims:
+            # unstructured grids compare each cell to its nearest neighbor in the given direction
+            if 'lat' not in dataset.coords or 'lon' not in dataset.coords:
+                raise ValueError('the contrast variance on ncol needs lat and lon coordinates')
+            neighbors = _ncol_neighbors(dataset['lat'].values, dataset['lon'].values, dir)
+            has_neighbor = xr.DataArray(neighbors >= 0, dims='ncol')
+            o_2 = dataset.isel(ncol=np.where(neighbors >= 0, neighbors, 0))
+            differences = (dataset - dataset.copy(data=o_2.data)).where(has_neighbor)
+            squares, count = _square_sums(differences, agg_dims)
+            return squares / count
+
+        dim = {'ns': 'lat', 'ew': 'lon', 'lev': 'lev'}[dir]
+        # each point is compared to the next one along dim, and keeps its own coordinates
+        lower = dataset.isel({dim: slice(None, -1)})
+        upper = dataset.isel({dim: slice(1, None)})
+        squares, count = _square_sums(lower - upper.data, agg_dims)
+        if dir != 'ew':
+            return squares / count
+
+        # longitudes wrap around, so the last one is also compared to the first
+        wrap_squares, wrap_count = _square_sums(
+            dataset.isel(lon=[-1]) - dataset.isel(lon=[0]).data, agg_dims
+        )
+        if 'lon' in agg_dims:
+            return (squares + wrap_squares) / (count + wrap_count)
+        return xr.concat([squares / count, wrap_squares / wrap_count], dim='lon')
 
     @property
     def ns_con_var(self) -> np.ndarray:
@@ -84,7 +832,7 @@ class DatasetMetrics(object):
         The North-South Contrast Variance averaged along the aggregate dimensions
         """
         if not self._is_memoized('_ns_con_var'):
-            self._ns_con_var = self._con_var('ns', self._ds).mean(self._agg_dims)
+            self._ns_con_var = self._con_var('ns', self._ds)
             self._ns_con_var.attrs = self._ds.attrs
             if hasattr(self._ds, 'units'):
                 self._ns_con_var.attrs['units'] = f'{self._ds.units}^2'
@@ -97,21 +845,35 @@ class DatasetMetrics(object):
         The East-West Contrast Variance averaged along the aggregate dimensions
         """
         if not self._is_memoized('_ew_con_var'):
-            self._ew_con_var = self._con_var('ew', self._ds).mean(self._agg_dims)
+            self._ew_con_var = self._con_var('ew', self._ds)
             self._ew_con_var.attrs = self._ds.attrs
             if hasattr(self._ds, 'units'):
                 self._ew_con_var.attrs['units'] = f'{self._ds.units}^2'
 
         return self._ew_con_var
 
+    @property
+    def lev_con_var(self) -> np.ndarray:
+        """
+        The vertical Contrast Variance (between neighboring levels) averaged along the aggregate dimensions
+        """
+        if not self._is_memoized('_lev_con_var'):
+            if 'lev' not in self._ds.dims:
+                raise ValueError('the vertical contrast variance needs a lev dimension')
+            self._lev_con_var = self._con_var('lev', self._ds)
+            self._lev_con_var.attrs = self._ds.attrs
+            if hasattr(self._ds, 'units'):
+                self._lev_con_var.attrs['units'] = f'{self._ds.units}^2'
+
+        return self._lev_con_var
+
     @property
     def mean(self) -> np.ndarray:
         """
         The mean along the aggregate dimensions
         """
         if not self._is_memoized('_mean'):
-            self._mean = self._ds.mean(self._agg_dims)
-            self._mean.attrs = self._ds.attrs
+            self._fill_moments()
 
         return self._mean
 
@@ -121,10 +883,7 @@ class DatasetMetrics(object):
         The mean of the absolute errors along the aggregate dimensions
         """
         if not self._is_memoized('_mean_abs'):
-            self._mean_abs = abs(self._ds).mean(self._agg_dims)
-            self._mean_abs.attrs = self._ds.attrs
-            if hasattr(self._ds, 'units'):
-                self._mean_abs.attrs['units'] = f'{self._ds.units}'
+            self._fill_moments()
 
         return self._mean_abs
 
@@ -147,20 +906,14 @@ class DatasetMetrics(object):
         The absolute value of the mean along the aggregate dimensions
         """
         if not self._is_memoized('_root_mean_squared'):
-            self._root_mean_squared = np.sqrt(np.square(self._ds).mean(dim=self._agg_dims))
-            self._root_mean_squared.attrs = self._ds.attrs
-            if hasattr(self._ds, 'units'):
-                self._root_mean_squared.attrs['units'] = f'{self._ds.units}'
+            self._fill_moments()
 
         return self._root_mean_squared
 
     @property
     def sum(self) -> np.ndarray:
         if not self._is_memoized('_sum'):
-            self._sum = self._ds.sum(dim=self._agg_dims)
-            self._sum.attrs = self._ds.attrs
-            if hasattr(self._ds, 'units'):
-                self._sum.attrs['units'] = f'{self._ds.units}'
+            self._fill_moments()
 
         return self._sum
 
@@ -180,10 +933,7 @@ class DatasetMetrics(object):
         The standard deviation along the aggregate dimensions
         """
         if not self._is_memoized('_std'):
-            self._std = self._ds.std(self._agg_dims)
-            self._std.attrs = self._ds.attrs
-            if hasattr(self._ds, 'units'):
-                self._std.attrs['units'] = ''
+            self._fill_moments()
 
         return self._std
 
@@ -193,10 +943,7 @@ class DatasetMetrics(object):
         The variance along the aggregate dimensions
         """
         if not self._is_memoized('_variance'):
-            self._variance = self._ds.var(self._agg_dims)
-            self._variance.attrs = self._ds.attrs
-            if hasattr(self._ds, 'units'):
-                self._variance.attrs['units'] = f'{self._ds.units}^2'
+            self._fill_moments()
 
         return self._variance
 
@@ -206,10 +953,7 @@ class DatasetMetrics(object):
         The probability that a point is positive
         """
         if not self._is_memoized('_prob_positive'):
-            self._prob_positive = (self._ds > 0).sum(self._agg_dims) / self._frame_size
-            self._prob_positive.attrs = self._ds.attrs
-            if hasattr(self._ds, 'units'):
-                self._prob_positive.attrs['units'] = ''
+            self._fill_moments()
         return self._prob_positive
 
     @property
@@ -218,10 +962,7 @@ class DatasetMetrics(object):
         The probability that a point is negative
         """
         if not self._is_memoized('_prob_negative'):
-            self._prob_negative = (self._ds < 0).sum(self._agg_dims) / self._frame_size
-            self._prob_negative.attrs = self._ds.attrs
-            if hasattr(self._ds, 'units'):
-                self._prob_negative.attrs['units'] = ''
+            self._fill_moments()
         return self._prob_negative
 
     @property
@@ -304,63 +1045,265 @@ class DatasetMetrics(object):
 
     @property
     def quantile_value(self) -> xr.DataArray:
-        self._quantile_value = self._ds.quantile(self.quantile, dim=self._agg_dims)
-        self._quantile_value.attrs = self._ds.attrs
-        if hasattr(self._ds, 'units'):
-            self._quantile_value.attrs['units'] = ''
+        self._quantile_value = self.quantiles(self.quantile)
 
         return self._quantile_value
 
+    def quantiles(self, q, approximate: bool = False, bins: int = 256) -> xr.DataArray:
+        """
+        The quantiles of the data along the aggregate dimensions at each point. Each quantile is only computed once,
+        and the quantiles not computed yet are computed together.
+
+        Parameters:
+        ===========
+        q -- float or list <float>
+            the quantile(s) to compute, between 0 and 1
+
+        Keyword Arguments:
+        ==================
+        approximate -- bool (default False)
+            if False, the quantiles are exact, which requires the aggregate dimensions to be in a single chunk (dask
+            data is rechunked as needed). If True, they are estimated from a histogram of bins bins between the
+            minimum and maximum at each point, which is computed chunk by chunk and merged, so memory is bounded by
+            the chunk size and bins counts per point. Each estimate is then within (max - min) / bins of the exact
+            quantile.
+        bins -- int (default 256)
+            the number of histogram bins of the approximate quantiles
+
+        Returns
+        =======
+        out -- xarray.DataArray
+            the quantiles at each point, with a 'quantile' dimension if q is a list
+        """
+        qs = np.atleast_1d(q).tolist()
+        key = bins if approximate else None
+        missing = [quantile for quantile in qs if (quantile, key) not in self._quantile_values]
+        if missing:
+            computed = (
+                self._approximate_quantiles(missing, bins)
+                if approximate
+                else self._exact_quantiles(missing)
+            )
+            for quantile in missing:
+                quantile_value = computed.sel(quantile=quantile)
+                quantile_value.attrs = self._ds.attrs
+                if hasattr(self._ds, 'units'):
+                    quantile_value.attrs['units'] = ''
+                self._quantile_values[(quantile, key)] = quantile_value
+
+        if np.ndim(q) == 0:
+            return self._quantile_values[(q, key)]
+        quantile_values = xr.concat(
+            [self._quantile_values[(quantile, key)] for quantile in qs], dim='quantile'
+        )
+        quantile_values.attrs = self._quantile_values[(qs[0], key)].attrs
+        return quantile_values
+
+    def _exact_quantiles(self, q: list) -> xr.DataArray:
+        agg_dims = list(self._ds.dims) if self._agg_dims is None else list(self._agg_dims)
+        ds = self._ds
+        if ds.chunks is not None:
+            ds = ds.chunk({dim: -1 for dim in agg_dims})
+        if ds.dtype == np.float64:
+            return ds.quantile(q, dim=agg_dims)
+
+        # interpolate between the neighboring values in float64 (as numpy's linear method does), rather than
+        # casting all the data
+        lower = ds.quantile(q, dim=agg_dims, method='lower').astype(np.float64)
+        higher = ds.quantile(q, dim=agg_dims, method='higher').astype(np.float64)
+        position = xr.DataArray(q, dims='quantile', coords={'quantile': q}) * (
+            ds.count(agg_dims) - 1
+        )
+        return lower + (higher - lower) * (position - np.floor(position))
+
+    def _approximate_quantiles(self, q: list, bins: int) -> xr.DataArray:
+        agg_dims = list(self._ds.dims) if self._agg_dims is None else list(self._agg_dims)
+        axis = tuple(self._ds.get_axis_num(dim) for dim in agg_dims)
+        lo = np.expand_dims(self.min_val.data, axis)
+        hi = np.expand_dims(self.max_val.data, axis)
+
+        data = self._ds.data
+        if isinstance(data, da.Array):
+            # one histogram per block, with the aggregate axes reduced to length 1, merged by a tree sum
+            chunks = tuple(
+                (1,) * len(chunks) if i in axis else chunks for i, chunks in enumerate(data.chunks)
+            )
+            extrema_chunks = tuple((1,) if i in axis else c for i, c in enumerate(data.chunks))
+            counts = da.map_blocks(
+                _histogram_chunk,
+                data,
+                da.asarray(lo).rechunk(extrema_chunks),
+                da.asarray(hi).rechunk(extrema_chunks),
+                axis=axis,
+                bins=bins,
+                chunks=chunks + ((bins,),),
+                new_axis=data.ndim,
+                dtype=np.int64,
+            )
+        else:
+            counts = _histogram_chunk(data, lo, hi, axis, bins)
+        counts = counts.sum(axis=axis)
+
+        lo = self.min_val.data
+        hi = self.max_val.data
+        if isinstance(counts, da.Array):
+            counts = counts.rechunk({counts.ndim - 1: -1})
+            quantiles = da.map_blocks(
+                _histogram_quantiles,
+                counts,
+                da.asarray(lo)[..., np.newaxis].rechunk(counts.chunks[:-1] + ((1,),)),
+                da.asarray(hi)[..., np.newaxis].rechunk(counts.chunks[:-1] + ((1,),)),
+                q=q,
+                chunks=counts.chunks[:-1] + ((len(q),),),
+                dtype=np.float64,
+            )
+        else:
+            quantiles = _histogram_quantiles(counts, lo, hi, q)
+        return xr.DataArray(
+            np.moveaxis(quantiles, -1, 0),
+            dims=['quantile'] + list(self.min_val.dims),
+            coords={**self.min_val.coords, 'quantile': q},
+        )
+
     @property
     def max_abs(self) -> xr.DataArray:
         if not self._is_memoized('_max_abs'):
-            self._max_abs = abs(self._ds).max(dim=self._agg_dims)
-            self._max_abs.attrs = self._ds.attrs
-            if hasattr(self._ds, 'units'):
-                self._max_abs.attrs['units'] = f'{self._ds.units}'
+            self._fill_moments()
 
         return self._max_abs
 
     @property
     def min_abs(self) -> xr.DataArray:
         if not self._is_memoized('_min_abs'):
-            self._min_abs = abs(self._ds).min(dim=self._agg_dims)
-            self._min_abs.attrs = self._ds.attrs
-            if hasattr(self._ds, 'units'):
-                self._min_abs.attrs['units'] = f'{self._ds.units}'
+            self._fill_moments()
 
         return self._min_abs
 
     @property
     def max_val(self) -> xr.DataArray:
         if not self._is_memoized('_max_val'):
-            self._max_val = self._ds.max(dim=self._agg_dims)
-            self._max_val.attrs = self._ds.attrs
-            if hasattr(self._ds, 'units'):
-                self._max_val.attrs['units'] = f'{self._ds.units}'
+            self._fill_moments()
 
         return self._max_val
 
     @property
     def min_val(self) -> xr.DataArray:
         if not self._is_memoized('_min_val'):
-            self._min_val = self._ds.min(dim=self._agg_dims)
-            self._min_val.attrs = self._ds.attrs
-            if hasattr(self._ds, 'units'):
-                self._min_val.attrs['units'] = f'{self._ds.units}'
+            self._fill_moments()
 
         return self._min_val
 
     @property
     def dyn_range(self) -> xr.DataArray:
         if not self._is_memoized('_range'):
-            self._dyn_range = abs((self._ds).max() - (self._ds).min())
+            self._dyn_range = abs(_as_float64(self._ds.max()) - _as_float64(self._ds.min()))
             self._dyn_range.attrs = self._ds.attrs
             if hasattr(self._ds, 'units'):
                 self._dyn_range.attrs['units'] = f'{self._ds.units}'
 
         return self._dyn_range
 
+    @property
+    def climatology(self) -> xr.DataArray:
+        """
+        The mean of each day of the year along the time dimension
+        """
+        if not self._is_memoized('_climatology'):
+            self._climatology = self._ds.groupby('time.dayofyear').mean(
+                dim='time', dtype=np.float64
+            )
+            self._climatology.attrs = self._ds.attrs
+
+        return self._climatology
+
+    def _deseasonalized(self) -> xr.DataArray:
+        """
+        The data minus its climatology (computed lazily, and only once)
+        """
+        if not self._is_memoized('_deseas_resid'):
+            # look up the climatology of each time step rather than subtracting group by group, which makes
+            # one task per day of the year. The residual keeps the precision of the data; its products are
+            # summed in float64.
+            climatology = self.climatology.astype(self._ds.dtype)
+            day_means = climatology.sel(dayofyear=self._ds.time.dt.dayofyear)
+            self._deseas_resid = self._ds - day_means.drop_vars('dayofyear')
+        return self._deseas_resid
+
+    def _lag_products(self, da: xr.DataArray, max_lag: int) -> xr.DataArray:
+        """
+        The sums of the products of da with itself 0 to max_lag time steps later, along time and the aggregate
+        dimensions, with a 'lag' dimension. Every lag is computed in a single pass over each time series.
+        """
+        dims = list(self._ds.dims) if self._agg_dims is None else list(self._agg_dims)
+        products = xr.apply_ufunc(
+            _lag_products_kernel,
+            da,
+            input_core_dims=[['time']],
+            output_core_dims=[['lag']],
+            kwargs={'max_lag': max_lag},
+            dask='parallelized',
+            output_dtypes=[np.float64],
+            dask_gufunc_kwargs={'allow_rechunk': True, 'output_sizes': {'lag': max_lag + 1}},
+        )
+        products = products.assign_coords(lag=np.arange(max_lag + 1)).transpose('lag', ...)
+        return products.sum([dim for dim in da.dims if dim in dims and dim != 'time'])
+
+    def _lag_product_sums_to(self, max_lag: int) -> xr.DataArray:
+        """
+        The lag products of the deseasonalized data at lags 0 to max_lag (computed lazily, and only again for a
+        larger max_lag)
+        """
+        if self._lag_product_sums is None or self._lag_product_sums.sizes['lag'] <= max_lag:
+            self._lag_product_sums = self._lag_products(self._deseasonalized(), max_lag)
+        return self._lag_product_sums.isel(lag=slice(0, max_lag + 1))
+
+    def autocovariance(self, max_lag: int = 1) -> xr.DataArray:
+        """
+        The autocovariance of the deseasonalized data at lags 1 to max_lag, pooled along time and the
+        aggregate dimensions
+
+        Keyword Arguments:
+        ==================
+        max_lag -- int (default 1)
+            the largest lag, in time steps
+
+        Returns
+        =======
+        out -- xarray.DataArray
+            the autocovariance at each point, with a 'lag' dimension
+        """
+        dims = list(self._ds.dims) if self._agg_dims is None else list(self._agg_dims)
+        count = self._deseasonalized().count(
+            [dim for dim in self._ds.dims if dim in dims + ['time']]
+        )
+        autocovariance = self._lag_product_sums_to(max_lag).isel(lag=slice(1, None)) / count
+        autocovariance.attrs = self._ds.attrs
+        if hasattr(self._ds, 'units'):
+            autocovariance.attrs['units'] = f'{self._ds.units}^2'
+        return autocovariance
+
+    def autocorrelation(self, max_lag: int = 1) -> xr.DataArray:
+        """
+        The autocorrelation of the deseasonalized data at lags 1 to max_lag, pooled along time and the
+        aggregate dimensions
+
+        Keyword Arguments:
+        ==================
+        max_lag -- int (default 1)
+            the largest lag, in time steps
+
+        Returns
+        =======
+        out -- xarray.DataArray
+            the autocorrelation at each point, with a 'lag' dimension
+        """
+        products = self._lag_product_sums_to(max_lag)
+        autocorrelation = products.isel(lag=slice(1, None)) / products.sel(lag=0, drop=True)
+        autocorrelation.attrs = self._ds.attrs
+        if hasattr(self._ds, 'units'):
+            autocorrelation.attrs['units'] = ''
+        return autocorrelation
+
     @property
     def lag1(self) -> xr.DataArray:
         """
@@ -368,17 +1311,9 @@ class DatasetMetrics(object):
         TODO: This metric currently returns a lat-lon array regardless of aggregate dimensions, so can only be used in a spatial plot.
         """
         if not self._is_memoized('_lag1'):
-            self._deseas_resid = self._ds.groupby('time.dayofyear') - self._ds.groupby(
-                'time.dayofyear'
-            ).mean(dim='time')
-
-            time_length = self._ds.sizes['time']
-            o_1, o_2 = xr.align(
-                self._deseas_resid.head({'time': time_length - 1}),
-                self._deseas_resid.tail({'time': time_length - 1}),
-                join='override',
-            )
-            self._lag1 = np.square((o_1 - o_2))
+            resid = self._deseasonalized()
+            later = resid.isel(time=slice(1, None))
+            self._lag1 = np.square(resid.isel(time=slice(None, -1)) - later.data)
             self._lag1.attrs = self._ds.attrs
             if hasattr(self._ds, 'units'):
                 self._lag1.attrs['units'] = ''
@@ -388,79 +1323,80 @@ class DatasetMetrics(object):
     @property
     def corr_lag1(self) -> xr.DataArray:
         """
-        The deseasonalized lag-1 correlation at each point by day of year
-        TODO: This metric currently returns a lat-lon array regardless of aggregate dimensions, so can only be used in a spatial plot.
+        The lag-1 autocorrelation of lag1 (the squared lag-1 differences of the deseasonalized data), pooled
+        along time and the aggregate dimensions
         """
         if not self._is_memoized('_corr_lag1'):
-            time_length = self._ds.sizes['time']
-            l_1, l_2 = xr.align(
-                self.lag1.head({'time': time_length - 2}),
-                self.lag1.tail({'time': time_length - 2}),
-                join='override',
-            )
-            self._corr_lag1 = np.multiply(l_1, l_2).sum(dim='time') / np.multiply(
-                self._lag1, self._lag1
-            ).sum(dim='time')
+            products = self._lag_products(self.lag1, 1)
+            self._corr_lag1 = products.sel(lag=1, drop=True) / products.sel(lag=0, drop=True)
             self._corr_lag1.attrs = self._ds.attrs
             if hasattr(self._ds, 'units'):
                 self._corr_lag1.attrs['units'] = ''
 
         return self._corr_lag1
 
-    @property
-    def zscore_cutoff(self) -> np.ndarray:
+    def _zscore_pvalues(self) -> xr.DataArray:
         """
-        The Z-Score cutoff for a point to be considered significant
-        TODO: Some single-value properties (liek this one) cannot be used in either spatial or time-series plots, there needs to be a way to specify which these are.
+        The two-sided p-value of the z-score at each point (computed lazily, and only once)
         """
-        if not self._is_memoized('_zscore_cutoff'):
-            pvals = 2 * (1 - ss.norm.cdf(np.abs(self.zscore)))
-            if isinstance(pvals, np.float64):
-                pvals_array = np.array(pvals)
-                sorted_pvals = pvals_array
-            else:
-                pvals_array = pvals
-                sorted_pvals = np.sort(pvals_array).flatten()
-            fdr_zscore = 0.01
-            p = np.argwhere(
-                sorted_pvals <= fdr_zscore * np.arange(1, pvals_array.size + 1) / pvals_array.size
-            )
-            pval_cutoff = np.empty(0)
-            if not len(p) == 0:
-                pval_cutoff = sorted_pvals[p[len(p) - 1]]
-            if not (pval_cutoff.size == 0):
+        if not self._is_memoized('_pvalues'):
+            # ndtr is the normal CDF as a ufunc, so dask-backed z-scores stay lazy
+            self._pvalues = 2 * special.ndtr(-abs(self.zscore))
+        return self._pvalues
+
+    def _fdr_significance(self):
+        """
+        The z-score cutoff and the percent of significant points under the Benjamini-Hochberg procedure at the
+        false discovery rate fdr, computed together and memoized per false discovery rate
+
+        Only p-values of at most fdr can be significant, and every smaller p-value is among them, so they are the
+        only values that need to be sorted to find their ranks.
+        """
+        if self._fdr not in self._fdr_significances:
+            pvals = self._zscore_pvalues().data.ravel()
+            n_tests, candidates = dask.compute((~np.isnan(pvals)).sum(), pvals[pvals <= self._fdr])
+            candidates = np.sort(candidates)
+            ranks = np.arange(1, candidates.size + 1)
+            significant = np.flatnonzero(candidates <= self._fdr * ranks / n_tests)
+            if significant.size > 0:
+                pval_cutoff = candidates[significant[-1:]]
                 zscore_cutoff = ss.norm.ppf(1 - pval_cutoff)
+                percent_sig = (
+                    100 * np.searchsorted(candidates, pval_cutoff[0], side='right') / n_tests
+                )
             else:
                 zscore_cutoff = 'na'
-            self._zscore_cutoff = zscore_cutoff
+                percent_sig = 0
+            self._fdr_significances[self._fdr] = (zscore_cutoff, percent_sig)
+        return self._fdr_significances[self._fdr]
 
-            return self._zscore_cutoff
+    @property
+    def fdr(self):
+        return self._fdr
+
+    @fdr.setter
+    def fdr(self, f):
+        self._fdr = f
+
+    @property
+    def zscore_cutoff(self) -> np.ndarray:
+        """
+        The Z-Score cutoff for a point to be considered significant, at the false discovery rate fdr
+        TODO: Some single-value properties (liek this one) cannot be used in either spatial or time-series plots, there needs to be a way to specify which these are.
+        """
+        zscore_cutoff, _ = self._fdr_significance()
+
+        return zscore_cutoff
 
     @property
     def zscore_percent_significant(self) -> np.ndarray:
         """
-        The percent of points where the zscore is considered significant
+        The percent of points where the zscore is considered significant, at the false discovery rate fdr
         TODO: Some single-value properties (liek this one) cannot be used in either spatial or time-series plots, there needs to be a way to specify which these are.
         """
-        if not self._is_memoized('_zscore_percent_significant'):
-            pvals = 2 * (1 - ss.norm.cdf(np.abs(self.zscore)))
-            if isinstance(pvals, np.float64):
-                pvals_array = np.array(pvals)
-                sorted_pvals = pvals_array
-            else:
-                pvals_array = pvals
-                sorted_pvals = np.sort(pvals_array).flatten()
-            fdr_zscore = 0.01
-            p = np.argwhere(sorted_pvals <= fdr_zscore * np.arange(1, pvals.size + 1) / pvals.size)
-            pval_cutoff = sorted_pvals[p[len(p) - 1]]
-            if not (pval_cutoff.size == 0):
-                sig_locs = np.argwhere(pvals <= pval_cutoff)
-                percent_sig = 100 * np.size(sig_locs, 0) / pvals.size
-            else:
-                percent_sig = 0
-            self._zscore_percent_significant = percent_sig
+        _, percent_sig = self._fdr_significance()
 
-            return self._zscore_percent_significant
+        return percent_sig
 
     def get_metric(self, name: str, q: Optional[int] = 0.5):
         """
@@ -475,12 +1411,23 @@ class DatasetMetrics(object):
         =======
         out -- xarray.DataArray
             a DataArray of the same size and dimensions the original dataarray, minus those dimensions that were aggregated across.
+            With a metric cache, the metric is computed (and stored in the cache) rather than returned lazily.
         """
+        if isinstance(name, str) and self._cache is not None:
+            metric = self._load_cached(name, q)
+            if metric is None:
+                metric = self._store_cached(name, q, self._get_metric(name, q))
+            return metric
+        return self._get_metric(name, q)
+
+    def _get_metric(self, name: str, q: Optional[int] = 0.5):
         if isinstance(name, str):
             if name == 'ns_con_var':
                 return self.ns_con_var
             if name == 'ew_con_var':
                 return self.ew_con_var
+            if name == 'lev_con_var':
+                return self.lev_con_var
             if name == 'mean':
                 return self.mean
             if name == 'std':
@@ -532,6 +1479,31 @@ class DatasetMetrics(object):
         else:
             raise TypeError('name must be a string.')
 
+    def get_metrics(self, names: list, q: Optional[int] = 0.5) -> xr.Dataset:
+        """
+        Gets several metrics aggregated across one or more dimensions of the dataset, computing all of
+        them together with a single dask.compute so that shared work is only done once
+
+        Parameters:
+        ===========
+        names -- list <string>
+            the names of the metrics (each must be a name accepted by get_metric)
+
+        Keyword Arguments:
+        ==================
+        q -- float (default 0.5)
+            the quantile to compute if 'quantile' is one of the names
+
+        Returns
+        =======
+        out -- xarray.Dataset
+            a Dataset with one variable per metric
+        """
+        if isinstance(names, str):
+            raise TypeError('names must be a list of strings.')
+        metrics = compute_metrics([(self, name) for name in names], q)
+        return xr.Dataset(dict(zip(names, metrics)))
+
     def get_single_metric(self, name: str):
         """
         Gets a metric consisting of a single float value
@@ -556,13 +1528,151 @@ class DatasetMetrics(object):
             raise TypeError('name must be a string.')
 
 
+class StreamingMetrics(object):
+    """
+    This class accumulates metrics for each point of a dataset across one or more dimensions incrementally, one
+    slice of data at a time (e.g. one history file per month of a run that is still being written). Only the
+    partial moments at each point are kept, so memory does not grow with the number of slices.
+    """
+
+    def __init__(self, aggregate_dims: Optional[list] = None):
+        self._agg_dims = ['time'] if aggregate_dims is None else list(aggregate_dims)
+        self._moments = None
+        self._dims = None
+        self._coords = None
+        self._attrs = {}
+        self._frame_size = 0
+
+    @property
+    def frame_size(self) -> int:
+        """
+        The number of values accumulated at each point so far
+        """
+        return self._frame_size
+
+    def update(self, ds: xr.DataArray) -> None:
+        """
+        Adds a slice of data to the accumulated metrics
+
+        Parameters:
+        ===========
+        ds -- xarray.DataArray
+            the new data, which must contain the aggregate dimensions and have the same remaining dimensions
+            as every previous slice
+        """
+        if not isinstance(ds, xr.DataArray):
+            raise TypeError(f'ds must be of type xarray.DataArray. Type: {str(type(ds))}')
+
+        dims = [dim for dim in ds.dims if dim not in self._agg_dims]
+        if self._dims is not None:
+            if set(dims) != set(self._dims):
+                raise ValueError(
+                    f'expected dimensions {self._dims} besides {self._agg_dims}, got {dims}'
+                )
+            ds = ds.transpose(*[dim for dim in ds.dims if dim in self._agg_dims], *self._dims)
+
+        axis = tuple(ds.get_axis_num(dim) for dim in self._agg_dims)
+        moments = _moments(ds.data, axis)
+        if isinstance(moments, da.Array):
+            moments = moments.compute()
+
+        frame_size = 1
+        for dim in self._agg_dims:
+            frame_size *= int(ds.sizes[dim])
+
+        if self._moments is None:
+            self._dims = dims
+            self._coords = {
+                name: coord
+                for name, coord in ds.coords.items()
+                if not set(coord.dims) & set(self._agg_dims)
+            }
+            self._attrs = dict(ds.attrs)
+            self._moments = moments
+        else:
+            self._moments = _moments_combine(
+                np.stack([self._moments, moments]), axis=(0,), keepdims=False
+            )
+        self._frame_size += frame_size
+
+    def merge(self, other: 'StreamingMetrics') -> None:
+        """
+        Merges the metrics accumulated by another StreamingMetrics object over the same points into this one
+        """
+        if other._moments is None:
+            return
+        if self._moments is None:
+            self._moments = other._moments.copy()
+            self._dims = other._dims
+            self._coords = other._coords
+            self._attrs = dict(other._attrs)
+        else:
+            if set(other._dims) != set(self._dims):
+                raise ValueError(f'expected dimensions {self._dims}, got {other._dims}')
+            other_moments = np.transpose(other._moments, [other._dims.index(d) for d in self._dims])
+            self._moments = _moments_combine(
+                np.stack([self._moments, other_moments]), axis=(0,), keepdims=False
+            )
+        self._frame_size += other._frame_size
+
+    def get_metric(self, name: str) -> xr.DataArray:
+        """
+        Gets a metric aggregated across the aggregate dimensions of every slice added so far
+
+        Parameters:
+        ===========
+        name -- string
+            the name of the metric (the same names as DatasetMetrics.get_metric, for the moment-based metrics)
+
+        Returns
+        =======
+        out -- xarray.DataArray
+            a DataArray with the dimensions of the slices, minus the aggregate dimensions
+        """
+        if not isinstance(name, str):
+            raise TypeError('name must be a string.')
+        if self._moments is None:
+            raise ValueError('no data has been added to the metrics yet.')
+
+        metrics = _moment_metrics(self._moments, self._dims, self._coords, self._frame_size)
+        slot = DatasetMetrics._METRIC_SLOTS.get(name)
+        if name == 'odds_positive':
+            metric = metrics['_prob_positive'] / (1 - metrics['_prob_positive'])
+            units_format = ''
+        elif name == 'mean_squared':
+            metric = np.square(metrics['_mean'])
+            units_format = '{}^2'
+        elif name == 'zscore':
+            n = xr.DataArray(self._moments['n'], dims=self._dims, coords=self._coords)
+            metric = metrics['_mean'] / (metrics['_std'] / np.sqrt(n))
+            units_format = ''
+        elif slot in metrics:
+            metric = metrics[slot]
+            units_format = DatasetMetrics._MOMENT_METRIC_UNITS[slot]
+        else:
+            raise ValueError(f'there is no streaming metric with the name: {name}.')
+
+        metric.attrs = self._attrs
+        if 'units' in self._attrs:
+            metric.attrs['units'] = units_format.format(self._attrs['units'])
+        return metric
+
+
 class DiffMetrics(object):
     """
     This class contains metrics on the overall dataset that require more than one input dataset to compute
+
+    upcast and weights have the same meaning as for DatasetMetrics. With weights, the covariance, the pearson
+    correlation coefficient and the normalized root mean squared error are computed from weighted averages.
     """
 
     def __init__(
-        self, ds1: xr.DataArray, ds2: xr.DataArray, aggregate_dims: Optional[list] = None,
+        self,
+        ds1: xr.DataArray,
+        ds2: xr.DataArray,
+        aggregate_dims: Optional[list] = None,
+        upcast: bool = True,
+        weights: Optional[xr.DataArray] = None,
     ) -> None:
         if isinstance(ds1, xr.DataArray):
             # Datasets
@@ -577,40 +1687,75 @@ class DiffMetrics(object):
                 f'ds must be of type xarray.DataArray. Type(s): {str(type(ds1))} {str(type(ds2))}'
             )
 
-        self._metrics1 = DatasetMetrics(self._ds1, aggregate_dims)
-        self._metrics2 = DatasetMetrics(self._ds2, aggregate_dims)
+        self._metrics1 = DatasetMetrics(self._ds1, aggregate_dims, upcast, weights=weights)
+        self._metrics2 = DatasetMetrics(self._ds2, aggregate_dims, upcast, weights=weights)
         self._aggregate_dims = aggregate_dims
+        self._weights = None if weights is None else weights.fillna(0)
         self._pcc = None
         self._covariance = None
         self._ks_p_value = None
+        self._ks_statistic = None
         self._n_rms = None
         self._n_emax = None
-        self._rel_spatial_error = None
+        self._spatial_rel_error = None
 
     def _is_memoized(self, metric_name: str) -> bool:
         return hasattr(self, metric_name) and (self.__getattribute__(metric_name) is not None)
 
+    def _mean(self, da: xr.DataArray, dim=None) -> xr.DataArray:
+        if self._weights is None:
+            return da.mean(dim=dim)
+        return da.weighted(self._weights).mean(dim=dim)
+
     @property
     def covariance(self) -> np.ndarray:
         """
         The covariance between the two datasets
         """
         if not self._is_memoized('_covariance'):
-            self._covariance = (
+            self._covariance = self._mean(
                 (self._metrics2.get_metric('ds') - self._metrics2.get_metric('mean'))
                 * (self._metrics1.get_metric('ds') - self._metrics1.get_metric('mean'))
-            ).mean()
+            )
 
         return self._covariance
 
     @property
     def ks_p_value(self):
         """
-        The Kolmogorov-Smirnov p-value
+        The two-sample Kolmogorov-Smirnov statistic of all the values in the two datasets, computed chunk-wise
+        without loading or sorting either dataset (if too many values cannot be told apart by histograms, an
+        upper bound on the statistic, with a RuntimeWarning)
         """
         if not self._is_memoized('_ks_p_value'):
-            self._ks_p_value = np.asanyarray(ss.ks_2samp(np.ravel(self._ds2), np.ravel(self._ds1)))
-        return self._ks_p_value[0]
+            self._ks_p_value = _chunked_ks_statistic(self._ds2.data, self._ds1.data)
+        return self._ks_p_value
+
+    @property
+    def ks_statistic(self) -> xr.DataArray:
+        """
+        The two-sample Kolmogorov-Smirnov statistic at each point, comparing the values of the two datasets
+        along the aggregate dimensions
+        """
+        if not self._is_memoized('_ks_statistic'):
+            agg_dims = (
+                list(self._ds1.dims) if self._aggregate_dims is None else list(self._aggregate_dims)
+            )
+            self._ks_statistic = xr.apply_ufunc(
+                _ks_statistic_kernel,
+                self._ds2,
+                self._ds1,
+                input_core_dims=[agg_dims, agg_dims],
+                kwargs={'n_core_dims': len(agg_dims)},
+                dask='parallelized',
+                output_dtypes=[np.float64],
+                dask_gufunc_kwargs={'allow_rechunk': True},
+            )
+            self._ks_statistic.attrs = self._ds1.attrs
+            if hasattr(self._ds1, 'units'):
+                self._ks_statistic.attrs['units'] = ''
+
+        return self._ks_statistic
 
     @property
     def pearson_correlation_coefficient(self):
@@ -633,7 +1778,13 @@ class DiffMetrics(object):
         by the range of values for the first set
         """
         if not self._is_memoized('_normalized_max_pointwise_error'):
-            tt = abs((self._metrics1.get_metric('ds') - self._metrics2.get_metric('ds')).max())
+            # the difference is exact in the precision of the data for nearby values, and only its maximum is
+            # upcast
+            tt = abs(
+                _as_float64(
+                    (self._metrics1.get_metric('ds') - self._metrics2.get_metric('ds')).max()
+                )
+            )
             self._n_emax = tt / self._metrics1.dyn_range
 
         return self._n_emax
@@ -645,30 +1796,62 @@ class DiffMetrics(object):
         by the range of values for the first set
         """
         if not self._is_memoized('_normalized_root_mean_squared'):
-            tt = np.sqrt(
-                np.square(self._metrics1.get_metric('ds') - self._metrics2.get_metric('ds')).mean(
-                    dim=self._aggregate_dims
-                )
+            squares, weights = _square_sums(
+                self._metrics1.get_metric('ds') - self._metrics2.get_metric('ds'),
+                self._aggregate_dims,
+                self._weights,
             )
+            tt = np.sqrt(squares / weights)
             self._n_rms = tt / self._metrics1.dyn_range
 
         return self._n_rms
 
+    def rel_error_exceedance(self, tol=None, keep_dims: Optional[list] = None) -> xr.DataArray:
+        """
+        The percentage of points whose relative error |ds1 - ds2| / |ds1| is above a tolerance
+
+        Keyword Arguments:
+        ==================
+        tol -- float or list <float> (default: the spre_tol of the first dataset's metrics)
+            the tolerance, or several tolerances to evaluate in a single pass over the data (returned along a
+            'tolerance' dimension)
+
+        keep_dims -- list <string> (default None)
+            dimensions to report the percentage along (e.g. ['time'] for each time slice or ['lev'] for each
+            level), rather than over every point
+
+        Returns
+        =======
+        out -- xarray.DataArray
+            the (lazy) percentage of points above the tolerance(s)
+        """
+        t1 = self._metrics1.get_metric('ds')
+        t2 = self._metrics2.get_metric('ds')
+        if tol is None:
+            tol = self._metrics1.spre_tol
+        # the comparison is made in the precision of the data, so float32 data is not upcast
+        dtype = t1.dtype if np.issubdtype(t1.dtype, np.floating) else np.float64
+        if np.ndim(tol) > 0:
+            tol = np.asarray(tol, dtype=np.float64)
+            tol = xr.DataArray(tol.astype(dtype), dims='tolerance', coords={'tolerance': tol})
+        else:
+            tol = np.asarray(tol, dtype=dtype)
+
+        # compare without dividing, so points where ds1 is zero count as errors whenever ds2 differs
+        exceeds = abs(t1 - t2) > tol * abs(t1)
+        keep_dims = [] if keep_dims is None else keep_dims
+        percent = exceeds.mean(dim=[dim for dim in t1.dims if dim not in keep_dims]) * 100
+        percent.attrs['units'] = '%'
+        return percent
+
     @property
     def spatial_rel_error(self):
         """
         At each grid point, we compute the relative error.  Then we report the percentage of grid point whose
         relative error is above the specified tolerance (1e-4 by default).
         """
-
         if not self._is_memoized('_spatial_rel_error'):
-            print(self._metrics1.get_metric('ds').shape)
-            sp_tol = self._metrics1.spre_tol
-            t1 = np.ravel(self._metrics1.get_metric('ds'))
-            t2 = np.ravel(self._metrics2.get_metric('ds'))
-            tt = (t1 - t2) / t1
-            a = len(tt[tt > sp_tol])
-            self._spatial_rel_error = (a / t1.shape[0]) * 100
+            self._spatial_rel_error = self.rel_error_exceedance()
 
         return self._spatial_rel_error
 
@@ -692,6 +1875,8 @@ class DiffMetrics(object):
                 return self.covariance
             if name == 'ks_p_value':
                 return self.ks_p_value
+            if name == 'ks_statistic':
+                return self.ks_statistic
             if name == 'n_rms':
                 return self.normalized_root_mean_squared
             if name == 'n_emax':
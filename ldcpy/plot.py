@@ -1,27 +1,213 @@
 import calendar
 import datetime
 import math
+import os
 import re
+from multiprocessing import Pool
 
 import cmocean
+import dask
 import matplotlib as mpl
 import numpy as np
 import pandas as pd
 import xrft
 from cartopy import crs as ccrs
-from cartopy.util import add_cyclic_point
+from cartopy import feature as cfeature
+from cartopy.mpl import patch as cpatch
+from matplotlib import collections as mcollections
 from matplotlib import dates as mdates
+from matplotlib import patches as mpatches
 from matplotlib import pyplot as plt
-from numpy import inf
+from matplotlib import tri as mtri
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 
 from ldcpy import metrics as lm
 from ldcpy import util as lu
 
+_map_template_cache = {}
+_MAP_TEMPLATE_CACHE_SIZE = 8
+
+
+def _cell_edges(centers):
+    """
+    The edges of cells with the given centers, halfway between neighboring centers
+    """
+    if centers.size == 1:
+        return np.array([centers[0] - 0.5, centers[0] + 0.5])
+    middles = (centers[1:] + centers[:-1]) / 2
+    return np.concatenate([[2 * centers[0] - middles[0]], middles, [2 * centers[-1] - middles[-1]]])
+
+
+def _color_range(*panels):
+    """
+    The color limits of maps of panels, from the values of each panel (already in memory)
+
+    Parameters:
+    ===========
+    panels -- xarray.DataArray
+        the data of the maps
+
+    Returns
+    =======
+    out -- tuple
+        the minimum and maximum of the finite values (None if there are none), whether all the values are NaN and
+        whether any values are infinite
+    """
+    color_min = color_max = None
+    all_nan = True
+    any_inf = False
+    for panel in panels:
+        values = np.ravel(panel.values)
+        finite = np.isfinite(values)
+        if not finite.all():
+            # only the values that are not finite need to be told apart
+            nans = np.isnan(values[~finite])
+            all_nan = all_nan and nans.all() and nans.size == values.size
+            any_inf = any_inf or not nans.all()
+        else:
+            all_nan = all_nan and values.size == 0
+        if finite.any():
+            panel_min = values.min(where=finite, initial=np.inf)
+            panel_max = values.max(where=finite, initial=-np.inf)
+            color_min = panel_min if color_min is None else min(color_min, panel_min)
+            color_max = panel_max if color_max is None else max(color_max, panel_max)
+    return color_min, color_max, all_nan, any_inf
+
+
+class MapTemplate(object):
+    """
+    This class holds the parts of a map that only depend on the grid of the data and the map projection: the grid
+    cells projected to map coordinates (or, on an unstructured 'ncol' grid, a triangulation of the projected cell
+    centers) and the projected coastlines. Data drawn with a template is not reprojected, and the data of a map
+    drawn with it can be replaced by other data on the same grid with set_data. Use map_template to get the
+    cached template of a grid.
+    """
+
+    def __init__(self, lat, lon, unstructured=False, projection=None):
+        self._projection = (
+            projection if projection is not None else ccrs.Robinson(central_longitude=0.0)
+        )
+        self._coastlines = None
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = (np.asarray(lon, dtype=np.float64) + 180) % 360 - 180
+
+        if unstructured:
+            points = self._projection.transform_points(ccrs.PlateCarree(), lon, lat)
+            self._triangulation = mtri.Triangulation(points[:, 0], points[:, 1])
+            # triangles across the dateline would otherwise be stretched across the whole map
+            triangle_lons = lon[self._triangulation.triangles]
+            self._triangulation.set_mask(
+                triangle_lons.max(axis=1) - triangle_lons.min(axis=1) > 180
+            )
+            return
+
+        self._triangulation = None
+        self._columns = np.argsort(lon, kind='stable')
+        lon_edges = _cell_edges(lon[self._columns])
+        # a cell across the dateline is split in two, one piece on each side of the map
+        if lon_edges[0] < -180:
+            self._columns = np.append(self._columns, self._columns[0])
+            lon_edges = np.append(lon_edges, 180)
+            lon_edges[0] = -180
+        elif lon_edges[-1] > 180:
+            self._columns = np.insert(self._columns, 0, self._columns[-1])
+            lon_edges = np.insert(lon_edges, 0, -180)
+            lon_edges[-1] = 180
+        lat_edges = np.clip(_cell_edges(lat), -90, 90)
+
+        corners = self._projection.transform_points(
+            ccrs.PlateCarree(), *np.meshgrid(lon_edges, lat_edges)
+        )
+        self._x = corners[..., 0]
+        self._y = corners[..., 1]
+
+    @property
+    def projection(self):
+        return self._projection
+
+    def _values(self, da):
+        # infinite values are clipped to the largest finite ones, so they are drawn in the under and over colors
+        if self._triangulation is not None:
+            values = np.array(da.values)
+        else:
+            values = da.transpose('lat', 'lon').values[:, self._columns]
+        if values.dtype.kind == 'f':
+            limit = np.finfo(values.dtype).max
+            np.clip(values, -limit, limit, out=values)
+        return values
+
+    def draw(self, ax, da, **kwargs):
+        """
+        Plots da on the map ax (which must use the projection of the template), returning the QuadMesh (or the
+        collection of triangles on an unstructured grid)
+        """
+        if self._triangulation is not None:
+            return ax.tripcolor(self._triangulation, self._values(da), **kwargs)
+        return ax.pcolormesh(
+            self._x, self._y, self._values(da), transform=self._projection, **kwargs
+        )
+
+    def set_data(self, mesh, da):
+        """
+        Replaces the data of a map drawn with draw by da, which must be on the same grid
+        """
+        mesh.set_array(self._values(da).ravel())
+
+    def add_coastlines(self, ax):
+        """
+        Draws the coastlines on the map ax, projecting them the first time only
+        """
+        if self._coastlines is None:
+            coastlines = []
+            for geometry in cfeature.COASTLINE.geometries():
+                projected = self._projection.project_geometry(geometry, cfeature.COASTLINE.crs)
+                coastlines.extend(cpatch.geos_to_path(projected))
+            self._coastlines = coastlines
+        return ax.add_collection(
+            mcollections.PathCollection(
+                self._coastlines, facecolor='none', edgecolor='black', transform=ax.transData
+            ),
+            autolim=False,
+        )
+
+
+def map_template(da, projection=None):
+    """
+    The MapTemplate of the grid of da, created the first time a grid is plotted
+
+    Parameters:
+    ===========
+    da -- xarray.DataArray
+        data on a lat/lon grid, or on an unstructured 'ncol' grid with 'lat' and 'lon' coordinates
+
+    Keyword Arguments:
+    ==================
+    projection -- cartopy.crs.Projection (default Robinson)
+        the map projection
+
+    Returns
+    =======
+    out -- MapTemplate
+    """
+    projection = projection if projection is not None else ccrs.Robinson(central_longitude=0.0)
+    lat = da['lat'].values
+    lon = da['lon'].values
+    unstructured = 'ncol' in da.dims
+    key = dask.base.tokenize(projection.proj4_init, lat, lon, unstructured)
+    template = _map_template_cache.get(key)
+    if template is None:
+        template = MapTemplate(lat, lon, unstructured, projection)
+        if len(_map_template_cache) >= _MAP_TEMPLATE_CACHE_SIZE:
+            _map_template_cache.pop(next(iter(_map_template_cache)))
+        _map_template_cache[key] = template
+    return template
+
 
 class MetricsPlot(object):
     """
-    This class contains code to plot metrics in an xarray Dataset that has either 'lat' and 'lon' dimensions, or a
-    'time' dimension.
+    This class contains code to plot metrics in an xarray Dataset that has either 'lat' and 'lon' dimensions (or an
+    unstructured 'ncol' dimension with 'lat' and 'lon' coordinates), or a 'time' dimension.
     """
 
     def __init__(
@@ -44,6 +230,7 @@ class MetricsPlot(object):
         standardized_err=False,
         quantile=None,
         contour_levs=24,
+        headless=False,
     ):
 
         self._ds = ds
@@ -70,6 +257,11 @@ class MetricsPlot(object):
         self._standardized_err = standardized_err
         self._quantile = None
         self._contour_levs = contour_levs
+        self._headless = headless
+
+        # DatasetMetrics of each piece of data used by the plot, shared by every stage of the plot so that
+        # nothing is computed twice
+        self._metrics_context = {}
 
     def verify_plot_parameters(self):
         if self._set2_name is None and self._metric_type in ['diff', 'ratio', 'metric_of_diff']:
@@ -101,27 +293,48 @@ class MetricsPlot(object):
         if self._quantile is None and self._metric == 'quantile':
             raise ValueError('Must specify quantile value as argument')
 
-    def get_metrics(self, da):
-        da_data = da
-        da_data.attrs = da.attrs
-        if self._metric_type == 'diff' and self._standardized_err is True:
-            if da.std(dim='time').all() == 0:
-                da_attrs = da.attrs
-                da_data = (da - da.mean(dim='time')) / da.std(dim='time')
-                da_data.attrs = da_attrs
-            else:
-                raise ValueError(
-                    'Standard deviation of error data is 0. Cannot standardize errors.'
-                )
+    def _dataset_metrics(self, da, aggregate_dims, weights=None, standardize=False):
+        """
+        The DatasetMetrics of da along aggregate_dims, created once per plot
+        """
+        key = (id(da), tuple(aggregate_dims), id(weights), standardize)
+        if key not in self._metrics_context:
+            da_data = da
+            da_data.attrs = da.attrs
+            if standardize:
+                if da.std(dim='time').all() == 0:
+                    da_attrs = da.attrs
+                    da_data = (da - da.mean(dim='time')) / da.std(dim='time')
+                    da_data.attrs = da_attrs
+                else:
+                    raise ValueError(
+                        'Standard deviation of error data is 0. Cannot standardize errors.'
+                    )
+            # da and weights are kept with their metrics, so their ids are not reused during the plot
+            self._metrics_context[key] = (
+                da,
+                weights,
+                lm.DatasetMetrics(da_data, aggregate_dims, weights=weights),
+            )
+        return self._metrics_context[key][2]
 
+    def metric_requests(self, da):
+        """
+        The metrics (as pairs of a DatasetMetrics object and a metric name) get_metrics needs for da
+        """
         if self._plot_type in ['spatial', 'spatial_comparison']:
-            metrics_da = lm.DatasetMetrics(da_data, ['time'])
+            aggregate_dims = ['time']
         elif self._plot_type in ['time_series', 'periodogram', 'histogram']:
-            metrics_da = lm.DatasetMetrics(da_data, ['lat', 'lon'])
+            aggregate_dims = ['ncol'] if 'ncol' in da.dims else ['lat', 'lon']
         else:
             raise ValueError(f'plot type {self._plot_type} not supported')
 
-        raw_data = metrics_da.get_metric(self._metric)
+        standardize = self._metric_type == 'diff' and self._standardized_err is True
+        return [(self._dataset_metrics(da, aggregate_dims, standardize=standardize), self._metric)]
+
+    def get_metrics(self, da):
+        [(metrics_da, metric)] = self.metric_requests(da)
+        raw_data = metrics_da.get_metric(metric)
         return raw_data
 
     def get_plot_data(self, raw_data_1, raw_data_2=None):
@@ -215,70 +428,58 @@ class MetricsPlot(object):
         update_label(None)
         return
 
+    def _figure(self, **kwargs):
+        """
+        A new figure, managed by pyplot (e.g. to show it in a notebook), or for headless plots a standalone figure
+        drawn with the Agg backend, which needs no display and does not touch the global pyplot state
+        """
+        if self._headless:
+            fig = Figure(**kwargs)
+            FigureCanvasAgg(fig)
+            return fig
+        return plt.figure(**kwargs)
+
+    def _map_panel(self, ax, da, **kwargs):
+        """
+        Plots the spatial data da on the map ax, as a mesh of its grid cells (or a triangulation of the cells of an
+        unstructured grid), with the projected grid cached for later plots of the same grid
+        """
+        template = map_template(da, ax.projection)
+        pc = template.draw(ax, da, **kwargs)
+        ax.set_global()
+        template.add_coastlines(ax)
+        return pc
+
     def spatial_comparison_plot(self, da_set1, title_set1, da_set2, title_set2):
-        lat_set1 = da_set1['lat']
-        lat_set2 = da_set2['lat']
-        cy_data_set1, lon_set1 = add_cyclic_point(da_set1, coord=da_set1['lon'])
-        cy_data_set2, lon_set2 = add_cyclic_point(da_set2, coord=da_set2['lon'])
+        color_min, color_max, all_nan, any_inf = _color_range(da_set1, da_set2)
 
-        fig = plt.figure(dpi=300, figsize=(9, 2.5))
+        fig = self._figure(dpi=300, figsize=(9, 2.5))
 
         mymap = plt.get_cmap(f'{self._color}')
         mymap.set_under(color='black')
         mymap.set_over(color='white')
         mymap.set_bad(alpha=0)
 
-        ax1 = plt.subplot(1, 2, 1, projection=ccrs.Robinson(central_longitude=0.0))
+        ax1 = fig.add_subplot(1, 2, 1, projection=ccrs.Robinson(central_longitude=0.0))
 
         ax1.set_facecolor('#39ff14')
         ax1.set_title(title_set1)
 
-        no_inf_data_set1 = np.nan_to_num(cy_data_set1, nan=np.nan)
-        color_min = min(
-            np.min(da_set1.where(da_set1 != -inf)).values.min(),
-            np.min(da_set2.where(da_set2 != -inf)).values.min(),
-        )
-        color_max = max(
-            np.max(da_set1.where(da_set1 != inf)).values.max(),
-            np.max(da_set2.where(da_set2 != inf)).values.max(),
-        )
-        pset2 = ax1.pcolormesh(
-            lon_set1,
-            lat_set1,
-            no_inf_data_set1,
-            transform=ccrs.PlateCarree(),
-            cmap=mymap,
-            vmin=color_min,
-            vmax=color_max,
-        )
-        ax1.set_global()
-        ax1.coastlines()
+        pset2 = self._map_panel(ax1, da_set1, cmap=mymap, vmin=color_min, vmax=color_max)
 
-        ax2 = plt.subplot(1, 2, 2, projection=ccrs.Robinson(central_longitude=0.0))
+        ax2 = fig.add_subplot(1, 2, 2, projection=ccrs.Robinson(central_longitude=0.0))
 
         ax2.set_facecolor('#39ff14')
         ax2.set_title(title_set2)
 
-        no_inf_data_set2 = np.nan_to_num(cy_data_set2, nan=np.nan)
-        pc2 = ax2.pcolormesh(
-            lon_set2,
-            lat_set2,
-            no_inf_data_set2,
-            transform=ccrs.PlateCarree(),
-            cmap=mymap,
-            vmin=color_min,
-            vmax=color_max,
-        )
-
-        ax2.set_global()
-        ax2.coastlines()
+        pc2 = self._map_panel(ax2, da_set2, cmap=mymap, vmin=color_min, vmax=color_max)
 
         # add colorbar
         fig.subplots_adjust(left=0.1, right=0.9, bottom=0.05, top=0.95)
         cax = fig.add_axes([0.1, 0, 0.8, 0.05])
 
-        if not (np.isnan(cy_data_set1).all() and np.isnan(cy_data_set2).all()):
-            if np.isinf(cy_data_set1).any() or np.isinf(cy_data_set2).any():
+        if color_min is not None:
+            if any_inf:
                 fig.colorbar(pset2, cax=cax, orientation='horizontal', shrink=0.95, extend='both')
                 cb = fig.colorbar(
                     pc2, cax=cax, orientation='horizontal', shrink=0.95, extend='both'
@@ -289,60 +490,49 @@ class MetricsPlot(object):
                 cb = fig.colorbar(pc2, cax=cax, orientation='horizontal', shrink=0.95)
                 cb.ax.set_title(f'{da_set1.units}')
             cb.ax.tick_params(labelsize=8, rotation=30)
-        else:
-            proxy = [plt.Rectangle((0, 0), 1, 1, fc='#39ff14')]
-            plt.legend(proxy, ['NaN'])
+        elif all_nan:
+            proxy = [mpatches.Rectangle((0, 0), 1, 1, fc='#39ff14')]
+            ax2.legend(proxy, ['NaN'])
 
-    def spatial_plot(self, da, title):
+        return fig
 
-        lat = da['lat']
-        cy_data, lon = add_cyclic_point(da, coord=da['lon'],)
+    def spatial_plot(self, da, title):
+        color_min, color_max, all_nan, any_inf = _color_range(da)
 
         mymap = plt.get_cmap(self._color)
         mymap.set_under(color='black')
         mymap.set_over(color='white')
         mymap.set_bad(alpha=0.0)
-        ax = plt.subplot(1, 1, 1, projection=ccrs.Robinson(central_longitude=0.0))
+        fig = self._figure()
+        ax = fig.add_subplot(1, 1, 1, projection=ccrs.Robinson(central_longitude=0.0))
 
         ax.set_facecolor('#39ff14')
 
-        masked_data = np.nan_to_num(cy_data, nan=np.nan)
-        color_min = np.min(da.where(da != -inf))
-        color_max = np.max(da.where(da != inf))
-        colorbar_minval = float(color_min)
-        colorbar_maxval = float(color_max)
-        pc = ax.pcolormesh(
-            lon,
-            lat,
-            masked_data,
-            transform=ccrs.PlateCarree(),
-            cmap=mymap,
-            vmin=colorbar_minval,
-            vmax=colorbar_maxval,
-        )
-        if not np.isnan(cy_data).all():
-            if np.isinf(cy_data).any():
-                cb = plt.colorbar(pc, orientation='horizontal', shrink=0.95, extend='both')
+        pc = self._map_panel(ax, da, cmap=mymap, vmin=color_min, vmax=color_max)
+        if color_min is not None:
+            if any_inf:
+                cb = fig.colorbar(pc, ax=ax, orientation='horizontal', shrink=0.95, extend='both')
             else:
-                cb = plt.colorbar(pc, orientation='horizontal', shrink=0.95)
+                cb = fig.colorbar(pc, ax=ax, orientation='horizontal', shrink=0.95)
             cb.ax.tick_params(labelsize=8, rotation=30)
             cb.ax.set_title(f'{da.units}')
-        else:
-            proxy = [plt.Rectangle((0, 0), 1, 1, fc='#39ff14')]
-            plt.legend(proxy, ['NaN'])
+        elif all_nan:
+            proxy = [mpatches.Rectangle((0, 0), 1, 1, fc='#39ff14')]
+            ax.legend(proxy, ['NaN'])
 
-        ax.set_global()
-        ax.coastlines()
         ax.set_title(title)
+        return fig
 
     def hist_plot(self, plot_data, title):
-        fig, axs = mpl.pyplot.subplots(1, 1, sharey=True, tight_layout=True)
+        fig = self._figure(tight_layout=True)
+        axs = fig.add_subplot(1, 1, 1)
         axs.hist(plot_data)
         if plot_data.units != '':
-            mpl.pyplot.xlabel(f'{self._metric} ({plot_data.units})')
+            axs.set_xlabel(f'{self._metric} ({plot_data.units})')
         else:
-            mpl.pyplot.xlabel(f'{self._metric}')
-        mpl.pyplot.title(f'time-series histogram: {title}')
+            axs.set_xlabel(f'{self._metric}')
+        axs.set_title(f'time-series histogram: {title}')
+        return fig
 
     def periodogram_plot(self, plot_data, title):
         dat = xrft.dft((plot_data - plot_data.mean()).chunk((plot_data - plot_data.mean()).size))
@@ -350,9 +540,11 @@ class MetricsPlot(object):
         i = np.log10(i[2 : int(dat.size / 2) + 1])
         freqs = np.array(range(1, int(dat.size / 2))) / dat.size
 
-        mpl.pyplot.subplots(1, 1, sharey=True, tight_layout=True)
-        mpl.pyplot.plot(freqs, i)
-        mpl.pyplot.title(f'periodogram: {title}')
+        fig = self._figure(tight_layout=True)
+        ax = fig.add_subplot(1, 1, 1)
+        ax.plot(freqs, i)
+        ax.set_title(f'periodogram: {title}')
+        return fig
 
     def time_series_plot(
         self, da, title,
@@ -396,39 +588,38 @@ class MetricsPlot(object):
         else:
             plot_ylabel = ylabel
 
-        plt.figure()
+        fig = self._figure()
+        ax = fig.add_subplot(1, 1, 1)
         if self._group_by is not None:
-            plt.plot(da[group_string].data, da, 'bo')
-            ax = plt.gca()
+            ax.plot(da[group_string].data, da, 'bo')
         else:
-            plt.gca().xaxis.set_major_formatter(mdates.DateFormatter('%m-%d-%Y'))
-            plt.gca().xaxis.set_major_locator(mdates.DayLocator())
+            ax.xaxis.set_major_formatter(mdates.DateFormatter('%m-%d-%Y'))
+            ax.xaxis.set_major_locator(mdates.DayLocator())
             dtindex = da.indexes['time'].to_datetimeindex()
             da['time'] = dtindex
 
-            mpl.pyplot.plot_date(da.time.data, da, 'bo')
-            ax = plt.gca()
+            ax.plot(da.time.data, da, 'bo')
 
-        mpl.pyplot.ylabel(plot_ylabel)
-        mpl.pyplot.yscale(self._scale)
+        ax.set_ylabel(plot_ylabel)
+        ax.set_yscale(self._scale)
         self._label_offset(ax)
-        mpl.pyplot.xlabel(xlabel)
+        ax.set_xlabel(xlabel)
 
         if self._group_by == 'time.month':
-            int_labels = np.setdiff1d(plt.xticks()[0].astype(int), 0)
+            int_labels = np.setdiff1d(ax.get_xticks().astype(int), 0)
             # no_hyphen_int_labels = [(int(float(re.sub('−', '-', label)))) for label in int_labels]
             month_labels = [
                 calendar.month_name[i] if calendar.month_name[i] != '' else '' for i in int_labels
             ]
             unique_month_labels = list(dict.fromkeys(month_labels))
-            plt.gca().set_xticklabels(unique_month_labels)
+            ax.set_xticklabels(unique_month_labels)
 
         if self._group_by is not None:
-            mpl.pyplot.xticks(
+            ax.set_xticks(
                 np.arange(min(da[group_string]), max(da[group_string]) + 1, tick_interval)
             )
         else:
-            mpl.pyplot.xticks(
+            ax.set_xticks(
                 pd.date_range(
                     np.datetime64(da['time'][0].data),
                     np.datetime64(da['time'][-1].data),
@@ -436,21 +627,33 @@ class MetricsPlot(object):
                 )
             )
 
-        mpl.pyplot.title(title)
+        ax.set_title(title)
+        return fig
+
+    def label_metric_requests(self, metric, data, weights=None):
+        """
+        The metrics (as pairs of a DatasetMetrics object and a metric name) get_metric_label needs for data
+        """
+        if metric == 'zscore':
+            return [(self._dataset_metrics(data, ['time']), 'zscore')]
+        if metric == 'mean' and self._plot_type == 'spatial_comparison':
+            return [(self._dataset_metrics(data, list(data.dims), weights), 'mean')]
+        return []
 
     def get_metric_label(self, metric, data, weights=None):
         # Get special metric names
         if metric == 'zscore':
-            zscore_cutoff = lm.DatasetMetrics((data), ['time']).get_single_metric('zscore_cutoff')
-            percent_sig = lm.DatasetMetrics((data), ['time']).get_single_metric(
-                'zscore_percent_significant'
-            )
-            metric_name = f'{metric}: cutoff {zscore_cutoff[0]:.2f}, % sig: {percent_sig:.2f}'
+            metrics_da = self._dataset_metrics(data, ['time'])
+            zscore_cutoff = metrics_da.get_single_metric('zscore_cutoff')
+            percent_sig = metrics_da.get_single_metric('zscore_percent_significant')
+            # the cutoff is 'na' when no point is significant
+            if not isinstance(zscore_cutoff, str):
+                zscore_cutoff = f'{zscore_cutoff[0]:.2f}'
+            metric_name = f'{metric}: cutoff {zscore_cutoff}, % sig: {percent_sig:.2f}'
         elif metric == 'mean' and self._plot_type == 'spatial_comparison':
-            o_wt_mean = np.average(
-                np.average(
-                    lm.DatasetMetrics(data, ['time']).get_metric(metric), axis=0, weights=weights,
-                )
+            # the weighted mean over every dimension, computed lazily instead of averaging the loaded time means
+            o_wt_mean = float(
+                self._dataset_metrics(data, list(data.dims), weights).get_metric(metric)
             )
             metric_name = f'{metric} = {o_wt_mean:.2f}'
         else:
@@ -479,6 +682,8 @@ def plot(
     quantile=None,
     start=None,
     end=None,
+    savefig=None,
+    headless=False,
 ):
     """
     Plots the data given an xarray dataset
@@ -497,6 +702,8 @@ def plot(
 
             'ew_con_var'
 
+            'lev_con_var'
+
             'mean'
 
             'std'
@@ -594,6 +801,8 @@ def plot(
 
             'autumn': data from the months September, October, November
 
+            a list of month numbers (e.g. [6, 7]): data from those months
+
     lat -- float (default None)
         the latitude of the data to gather metrics on.
 
@@ -613,16 +822,27 @@ def plot(
         a value between 0 and 1 required if metric="quantile", corresponding to the desired quantile to gather
 
 
-    start -- int (default None)
-        a value between 0 and the number of time slices indicating the start time of a subset
+    start -- int or string (default None)
+        a value between 0 and the number of time slices indicating the start time of a subset, or the start date
+        of the subset (e.g. '2000-01-15')
+
+
+    end -- int or string (default None)
+        a value between 0 and the number of time slices indicating the end time of a subset, or the end date of
+        the subset (included)
 
+    savefig -- string (default None)
+        the path of a file to save the plot to (in a format given by its extension, e.g. '.png'). The plot is then
+        drawn headless.
 
-    end -- int (default None)
-        a value between 0 and the number of time slices indicating the end time of a subset
+    headless -- bool (default False)
+        whether to draw the plot without pyplot or a display (with the Agg backend) and return its figure, so it
+        can be rendered in a script or in parallel with other plots
 
     Returns
     =======
-    out -- None
+    out -- None, matplotlib.figure.Figure or string
+        the figure of a headless plot, or the path of the saved file if savefig is given
     """
 
     mp = MetricsPlot(
@@ -643,6 +863,7 @@ def plot(
         color,
         standardized_err,
         quantile,
+        headless=headless or savefig is not None,
     )
 
     mp.verify_plot_parameters()
@@ -666,22 +887,32 @@ def plot(
     else:
         data = subset_set1
 
-    raw_metric_set1 = mp.get_metrics(data)
+    # spatial means are weighted by the latitude weights, or by the cell areas on unstructured grids
+    if 'ncol' in data.dims and ds.variables.mapping.get('area') is not None:
+        weights = ds['area']
+    elif ds.variables.mapping.get('gw') is not None:
+        weights = ds['gw']
+    else:
+        weights = None
+
+    # compute the metrics and the values in the titles together, so each reduction runs once
     # TODO: This will plot a second plot even if metric_type is metric_of diff in spatial comparison case
-    if plot_type in ['spatial_comparison'] or metric_type in ['diff', 'ratio']:
+    compare_set2 = plot_type in ['spatial_comparison'] or metric_type in ['diff', 'ratio']
+    requests = mp.metric_requests(data) + mp.label_metric_requests(metric, data, weights)
+    if compare_set2:
+        requests += mp.metric_requests(subset_set2)
+    if metric == 'mean' and plot_type == 'spatial_comparison':
+        requests += mp.label_metric_requests(metric, subset_set2, weights)
+    lm.compute_metrics(requests)
+
+    raw_metric_set1 = mp.get_metrics(data)
+    if compare_set2:
         raw_metric_set2 = mp.get_metrics(subset_set2)
 
     # Get metric names/values for plot title
-    # if metric == 'zscore':
-    if ds.variables.mapping.get('gw') is not None:
-        metric_name_set1 = mp.get_metric_label(metric, data, ds['gw'].values)
-    else:
-        metric_name_set1 = mp.get_metric_label(metric, data)
+    metric_name_set1 = mp.get_metric_label(metric, data, weights)
     if metric == 'mean' and plot_type == 'spatial_comparison':
-        if ds.variables.mapping.get('gw') is not None:
-            metric_name_set2 = mp.get_metric_label(metric, subset_set2, ds['gw'].values)
-        else:
-            metric_name_set1 = mp.get_metric_label(metric, data)
+        metric_name_set2 = mp.get_metric_label(metric, subset_set2, weights)
 
     # Get plot data and title
     if lat is not None and lon is not None:
@@ -704,12 +935,187 @@ def plot(
 
     # Call plot functions
     if plot_type == 'spatial_comparison':
-        mp.spatial_comparison_plot(plot_data_set1, title_set1, plot_data_set2, title_set2)
+        fig = mp.spatial_comparison_plot(plot_data_set1, title_set1, plot_data_set2, title_set2)
     elif plot_type == 'spatial':
-        mp.spatial_plot(plot_data_set1, title_set1)
+        fig = mp.spatial_plot(plot_data_set1, title_set1)
     elif plot_type == 'time_series':
-        mp.time_series_plot(plot_data_set1, title_set1)
+        fig = mp.time_series_plot(plot_data_set1, title_set1)
     elif plot_type == 'histogram':
-        mp.hist_plot(plot_data_set1, title_set1)
+        fig = mp.hist_plot(plot_data_set1, title_set1)
     elif plot_type == 'periodogram':
-        mp.periodogram_plot(plot_data_set1, title_set1)
+        fig = mp.periodogram_plot(plot_data_set1, title_set1)
+
+    return _save(fig, savefig, headless)
+
+
+def _save(fig, savefig, headless):
+    if savefig is not None:
+        fig.savefig(savefig)
+        return savefig
+    # pyplot shows its own figures, so returning them would show them twice in a notebook
+    return fig if headless else None
+
+
+def plot_grid(
+    ds,
+    varname,
+    metrics,
+    sets,
+    subset=None,
+    lev=0,
+    color='coolwarm',
+    start=None,
+    end=None,
+    savefig=None,
+    headless=False,
+):
+    """
+    Plots a grid of spatial plots in a single figure, with one row per metric and one column per collection. The
+    metrics of every panel are computed together, and the panels of each row share one color scale.
+
+    Parameters:
+    ===========
+    ds -- xarray.Dataset
+        the dataset
+    varname -- string
+        the name of the variable to be plotted
+    metrics -- list <string>
+        the names of the metrics to be plotted (see plot for the available metrics)
+    sets -- list <string>
+        the labels of the datasets to gather metrics from
+
+    Keyword Arguments:
+    ==================
+    subset -- string (default None)
+        subset of the data to gather metrics on (see plot for the valid options)
+
+    lev -- float (default 0)
+        the level of the data to gather metrics on (used if plotting from a 3d data set).
+
+    color -- string (default 'coolwarm')
+        the color scheme for the plots (see https://matplotlib.org/3.1.1/gallery/color/colormap_reference.html)
+
+    start -- int or string (default None)
+        a value between 0 and the number of time slices indicating the start time of a subset, or the start date
+        of the subset (e.g. '2000-01-15')
+
+    end -- int or string (default None)
+        a value between 0 and the number of time slices indicating the end time of a subset, or the end date of
+        the subset (included)
+
+    savefig -- string (default None)
+        the path of a file to save the plot to, drawing it headless (see plot)
+
+    headless -- bool (default False)
+        whether to draw the plot without pyplot or a display and return its figure (see plot)
+
+    Returns
+    =======
+    out -- None, matplotlib.figure.Figure or string
+        the figure of a headless plot, or the path of the saved file if savefig is given
+    """
+    mp = MetricsPlot(
+        ds,
+        varname,
+        sets[0],
+        metrics[0],
+        subset=subset,
+        lev=lev,
+        color=color,
+        headless=headless or savefig is not None,
+    )
+    mp.verify_plot_parameters()
+
+    requests = []
+    for set_name in sets:
+        if 'collection' in ds[varname].dims:
+            da = ds[varname].sel(collection=set_name)
+        else:
+            da = ds[varname]
+        data = lu.subset_data(da, subset, lev=lev, start=start, end=end)
+        requests += [(mp._dataset_metrics(data, ['time']), metric) for metric in metrics]
+    panels = lm.compute_metrics(requests)
+
+    mymap = plt.get_cmap(color)
+    mymap.set_under(color='black')
+    mymap.set_over(color='white')
+    mymap.set_bad(alpha=0.0)
+    fig = mp._figure(figsize=(3 * len(sets), 1.8 * len(metrics)))
+    axs = fig.subplots(
+        len(metrics),
+        len(sets),
+        subplot_kw={'projection': ccrs.Robinson(central_longitude=0.0)},
+        squeeze=False,
+    )
+    for row, metric in enumerate(metrics):
+        row_panels = panels[row :: len(metrics)]
+        color_min, color_max, _, _ = _color_range(*row_panels)
+
+        for col, (set_name, panel) in enumerate(zip(sets, row_panels)):
+            ax = axs[row, col]
+            ax.set_facecolor('#39ff14')
+            pc = mp._map_panel(ax, panel, cmap=mymap, vmin=color_min, vmax=color_max)
+            ax.set_title(f'{set_name}: {varname}: {metric}', fontsize=8)
+
+        if color_min is not None:
+            cb = fig.colorbar(pc, ax=axs[row, :].tolist(), shrink=0.9)
+            cb.ax.tick_params(labelsize=6)
+            cb.ax.set_title(f'{row_panels[0].attrs.get("units", "")}', fontsize=6)
+
+    return _save(fig, savefig, headless)
+
+
+_render_dataset = None
+
+
+def _init_render_worker(ds):
+    global _render_dataset
+    _render_dataset = ds
+    # the plots are rendered in parallel by the processes, so each one computes its data on its own
+    dask.config.set(scheduler='synchronous')
+
+
+def _render_plot(kwargs):
+    return plot(_render_dataset, **kwargs)
+
+
+def _plot_filename(kwargs):
+    name = '_'.join(str(value) for value in kwargs.values() if value is not None)
+    return f"{re.sub(r'[^A-Za-z0-9.=-]+', '_', name)}.png"
+
+
+def render_plots(ds, plots, outdir, max_workers=None):
+    """
+    Renders many plots to image files in parallel, in a pool of processes
+
+    Parameters:
+    ===========
+    ds -- xarray.Dataset
+        the dataset
+    plots -- list <dict>
+        the keyword arguments of plot for each plot (e.g. {'varname': 'TS', 'metric': 'mean', 'set1': 'orig'}).
+        Each plot is saved to the file named by its 'savefig' argument in outdir, or by default to a PNG file
+        named after its arguments.
+    outdir -- string
+        the directory to save the plots in (created if needed)
+
+    Keyword Arguments:
+    ==================
+    max_workers -- int (default None)
+        the number of processes (by default, the number of processors)
+
+    Returns
+    =======
+    out -- list <string>
+        the paths of the saved files, in the order of the plots
+    """
+    os.makedirs(outdir, exist_ok=True)
+    jobs = []
+    for kwargs in plots:
+        kwargs = dict(kwargs)
+        filename = kwargs.pop('savefig', None) or _plot_filename(kwargs)
+        kwargs['savefig'] = os.path.join(outdir, filename)
+        jobs.append(kwargs)
+
+    with Pool(max_workers, _init_render_worker, (ds,)) as pool:
+        return pool.map(_render_plot, jobs)
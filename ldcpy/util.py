@@ -1,12 +1,32 @@
+import hashlib
+import json
+import os
+import time
+from collections.abc import Mapping
+from functools import partial
+
+import dask
+import numpy as np
+import pandas as pd
 import xarray as xr
+from dask.callbacks import Callback
+from scipy.spatial import cKDTree
 
-from .metrics import DatasetMetrics, DiffMetrics
+from .metrics import DatasetMetrics, DiffMetrics, _unit_vectors
 
 
-def open_datasets(varnames, list_of_files, labels, **kwargs):
+def open_datasets(
+    varnames,
+    list_of_files,
+    labels,
+    parallel=False,
+    aggregate_dims=None,
+    use_materialized=True,
+    **kwargs,
+):
     """
-    Open several different netCDF files, concatenate across
-    a new 'collection' dimension, which can be accessed with labels.
+    Open several different netCDF files (or Zarr stores, intake-esm catalog entries or xarray datasets),
+    concatenate across a new 'collection' dimension, which can be accessed with labels.
     Stores them in an xarray dataset.
 
     Parameters:
@@ -14,20 +34,44 @@ def open_datasets(varnames, list_of_files, labels, **kwargs):
     varnames -- list <string>
            the variable(s) of interest to combine across input files (usually just one)
 
-    list_of_files -- list <string>
-        the file paths for the netCDF file(s) to be opened
+    list_of_files -- list <string, MutableMapping, intake_esm.esm_datastore or xarray.Dataset>
+        the file paths for the netCDF file(s) to be opened. Paths ending in '.zarr' or naming a directory, and
+        mappings (e.g. an fsspec mapper), are opened as Zarr stores with xarray.open_zarr(), using their
+        consolidated metadata when they have it. An intake-esm catalog subset must hold exactly one dataset,
+        and xarray datasets are used as they are.
 
     labels -- list <string>
         the respective label to access data from each netCDF file (also used in plotting fcns)
 
-    **kwargs (optional) – Additional arguments passed on to xarray.open_mfdataset(). A list of available arguments can
-    be found here: http://xarray.pydata.org/en/stable/generated/xarray.open_dataset.html
+    Keyword Arguments:
+    ==================
+    parallel -- bool (default False)
+        if True, the files are opened in parallel with dask.delayed, which mostly helps on parallel file
+        systems where opening a file is dominated by metadata latency
+    aggregate_dims -- list <string> (default None)
+        with chunks='auto', the dimensions the metrics will be aggregated across (e.g. ['time'] for spatial maps
+        or ['lat', 'lon'] for time series). These dimensions are kept whole in every dask chunk.
+    use_materialized -- bool (default True)
+        if True and these files were saved with materialize() for the same variables and labels, the Zarr copy
+        is opened instead, as long as none of the files changed since and no arguments other than 'chunks' are
+        given. Only datasets opened from local files with this set can be materialized.
+
+    **kwargs (optional) – Additional arguments passed on to xarray.open_dataset() for each file, or to
+    xarray.combine_nested() for the arguments that control how the files are combined ('compat', 'coords', 'join'
+    and 'combine_attrs'). They default to those of xarray.open_mfdataset, except that when some inputs are Zarr
+    stores, catalog entries or datasets, coords defaults to 'minimal' and compat to 'override', so that combining
+    them does not read their data to compare it. A 'preprocess' function is applied to each dataset before combining, as in
+    xarray.open_mfdataset(). A list of available arguments can be found here:
+    http://xarray.pydata.org/en/stable/generated/xarray.open_dataset.html
+    With chunks='auto', the dask chunks are multiples of the chunks the variables are stored with on disk, with
+    about as many bytes as the dask 'array.chunk-size' setting.
 
     Returns
     =======
     out -- xarray.Dataset
           contains all the data from the list of files
     """
+    start = time.perf_counter()
 
     # Error checking:
     # list_of_files and ensemble_names must be same length
@@ -35,32 +79,320 @@ def open_datasets(varnames, list_of_files, labels, **kwargs):
         labels
     ), 'open_dataset file list and labels arguments must be the same length'
 
+    sources = _source_manifest(list_of_files) if use_materialized else None
+    store = None
+    # the stored copy was opened with the default arguments, so it cannot stand in for other ones
+    if sources is not None and set(kwargs) <= {'chunks'}:
+        store = _find_materialized(sources, varnames, labels)
+    if store is not None:
+        print('using the materialized copy of these files at', store)
+        chunks = kwargs.get('chunks', 'auto')
+        # by default the store is read with the chunks it was written with
+        full_ds = xr.open_zarr(store, consolidated=True, chunks={} if chunks == 'auto' else chunks)
+        full_ds.encoding['ldcpy_sources'] = {
+            'sources': sources,
+            'varnames': list(varnames),
+            'labels': list(labels),
+        }
+        print('opened {} in {:0.2f} s'.format(store, time.perf_counter() - start))
+        print('dataset size in GB {:0.2f}\n'.format(full_ds.nbytes / 1e9))
+        return full_ds
+
     # check whether we need to set chunks or the user has already done so
     if 'chunks' not in kwargs:
         print("chucks set to (default) {'time', 50}")
         kwargs['chunks'] = {'time': 50}
+    elif kwargs['chunks'] == 'auto':
+        print('chunks set to (auto) from the on-disk chunks and aggregate dims ', aggregate_dims)
     else:
         print('chunks set to (by user) ', kwargs['chunks'])
 
-    # check that varname exists in each file
-    for filename in list_of_files:
-        ds_check = xr.open_dataset(filename)
+    auto_chunks = kwargs['chunks'] == 'auto'
+    if auto_chunks:
+        # the files are opened without dask, and chunked once the on-disk layout is known
+        kwargs['chunks'] = None
+
+    combine_kwargs = {name: kwargs.pop(name) for name in _COMBINE_KWARGS if name in kwargs}
+    preprocess = kwargs.pop('preprocess', None)
+
+    if not all(_is_netcdf(source) for source in list_of_files):
+        # Zarr stores (often remote) and catalog entries are combined without reading their variables and
+        # coordinates to compare them
+        combine_kwargs.setdefault('coords', 'minimal')
+        combine_kwargs.setdefault('compat', 'override')
+    # like xarray.open_mfdataset, keep the attributes of the first file (combine_nested drops them by default)
+    combine_kwargs.setdefault('combine_attrs', 'override')
+
+    # each file is opened only once: the handles are used both to check the variables and to build the dataset
+    if parallel:
+        open_ = dask.delayed(_open_source)
+        datasets = list(dask.compute(*[open_(source, **kwargs) for source in list_of_files]))
+    else:
+        datasets = [_open_source(source, **kwargs) for source in list_of_files]
+    # datasets passed in by the caller are left open when the combined dataset is closed
+    closers = [
+        ds_file._close
+        for source, ds_file in zip(list_of_files, datasets)
+        if not isinstance(source, xr.Dataset)
+    ]
+
+    # check that varname exists in each file (this only looks at the file headers)
+    for source, label, ds_check in zip(list_of_files, labels, datasets):
+        filename = source if isinstance(source, (str, os.PathLike)) else label
         for thisvar in varnames:
             if thisvar not in ds_check.variables:
                 print(f"We have a problem. Variable '{thisvar}' is not in the file {filename}")
-        ds_check.close()
 
-    full_ds = xr.open_mfdataset(
-        list_of_files, concat_dim='collection', combine='nested', data_vars=varnames, **kwargs,
-    )
+    if auto_chunks:
+        datasets = [
+            ds_file.chunk(_auto_chunks(ds_file, varnames, aggregate_dims)) for ds_file in datasets
+        ]
 
-    full_ds['collection'] = xr.DataArray(labels, dims='collection')
+    if preprocess is not None:
+        datasets = [preprocess(ds_file) for ds_file in datasets]
 
+    try:
+        full_ds = xr.combine_nested(
+            datasets, concat_dim='collection', data_vars=varnames, **combine_kwargs
+        )
+    except Exception:
+        _close_all(closers)
+        raise
+
+    full_ds['collection'] = xr.DataArray(labels, dims='collection')
+    if 'ncol' in full_ds.dims:
+        # the locations and areas of unstructured grid cells are kept with the variables, so metrics and plots
+        # can use them without the rest of the dataset
+        full_ds = full_ds.set_coords(
+            [name for name in ['lat', 'lon', 'area'] if name in full_ds.data_vars]
+        )
+    # set after set_coords, which returns a new dataset without the closer
+    full_ds.set_close(partial(_close_all, closers))
+    if sources is not None:
+        # used by materialize to recognize these files later
+        full_ds.encoding['ldcpy_sources'] = {
+            'sources': sources,
+            'varnames': list(varnames),
+            'labels': list(labels),
+        }
+
+    print('opened {} files in {:0.2f} s'.format(len(list_of_files), time.perf_counter() - start))
     print('dataset size in GB {:0.2f}\n'.format(full_ds.nbytes / 1e9))
 
     return full_ds
 
 
+# Arguments of open_datasets that are passed on to xarray.combine_nested instead of xarray.open_dataset
+_COMBINE_KWARGS = ['compat', 'coords', 'join', 'combine_attrs']
+
+
+def materialize(ds, path, aggregate_dims=None):
+    """
+    Write a dataset opened with open_datasets to a Zarr store, chunked for the metrics that will be computed on
+    it. Later calls to open_datasets with the same files, variables and labels open the store instead of the
+    original files (skipping their decompression), as long as none of the files changed since.
+
+    Parameters:
+    ===========
+    ds -- xarray.Dataset
+        a dataset returned by open_datasets
+    path -- string
+        the path of the Zarr store to write (it is overwritten if it exists)
+
+    Keyword Arguments:
+    ==================
+    aggregate_dims -- list <string> (default None)
+        the dimensions the metrics will be aggregated across (e.g. ['time'] for spatial maps or ['lat', 'lon']
+        for time series), which are not split across chunks of the store
+
+    Returns
+    =======
+    out -- xarray.Dataset
+        the dataset read back from the Zarr store
+    """
+    manifest = ds.encoding.get('ldcpy_sources')
+    if manifest is None:
+        raise ValueError(
+            'only datasets opened with open_datasets from local files (with use_materialized) can be materialized'
+        )
+
+    # each collection is stored in its own chunks, laid out like the files it was read from
+    chunks = _auto_chunks(ds.isel(collection=0), manifest['varnames'], aggregate_dims)
+    chunks['collection'] = 1
+    ds = ds.chunk(chunks)
+    for var in ds.variables.values():
+        for name in ['chunks', 'chunksizes', 'preferred_chunks', 'contiguous']:
+            var.encoding.pop(name, None)
+
+    ds.to_zarr(path, mode='w', consolidated=True)
+    with open(os.path.join(path, _MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f)
+
+    registry = _load_materialized_registry()
+    registry[_materialized_key(manifest)] = os.path.abspath(path)
+    registry_path = _materialized_registry_path()
+    os.makedirs(os.path.dirname(registry_path), exist_ok=True)
+    with open(f'{registry_path}.tmp', 'w') as f:
+        json.dump(registry, f, indent=2)
+    os.replace(f'{registry_path}.tmp', registry_path)
+
+    return xr.open_zarr(path, consolidated=True)
+
+
+# Name of the file in a materialized Zarr store that describes the files it was written from
+_MANIFEST_NAME = 'ldcpy_manifest.json'
+
+
+def _source_manifest(list_of_files):
+    """
+    The path, size and modification time of each input of open_datasets, or None if some inputs are not local
+    files (e.g. URLs or in-memory datasets)
+    """
+    sources = []
+    for source in list_of_files:
+        if not isinstance(source, (str, os.PathLike)) or not os.path.exists(source):
+            return None
+        stat = os.stat(source)
+        sources.append(
+            {'path': os.path.abspath(source), 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+        )
+    return sources
+
+
+def _materialized_key(manifest):
+    paths = [source['path'] for source in manifest['sources']]
+    description = json.dumps([paths, manifest['varnames'], manifest['labels']])
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+def _materialized_registry_path():
+    cache_home = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'ldcpy', 'materialized.json')
+
+
+def _load_materialized_registry():
+    try:
+        with open(_materialized_registry_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _find_materialized(sources, varnames, labels):
+    """
+    The path of an up-to-date materialized copy of the given files, or None if there is none
+    """
+    manifest = {'sources': sources, 'varnames': list(varnames), 'labels': list(labels)}
+    store = _load_materialized_registry().get(_materialized_key(manifest))
+    if store is None:
+        return None
+    try:
+        with open(os.path.join(store, _MANIFEST_NAME)) as f:
+            stored_manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # the copy is stale if any file was modified since it was written
+    if stored_manifest != manifest:
+        return None
+    return store
+
+
+def _is_zarr(source):
+    return isinstance(source, Mapping) or (
+        isinstance(source, (str, os.PathLike))
+        and (str(source).rstrip('/').endswith('.zarr') or os.path.isdir(source))
+    )
+
+
+def _is_netcdf(source):
+    return isinstance(source, (str, os.PathLike)) and not _is_zarr(source)
+
+
+def _open_source(source, **kwargs):
+    """
+    Opens one of the inputs of open_datasets as an xarray dataset
+    """
+    if isinstance(source, xr.Dataset):
+        return source
+
+    if hasattr(source, 'to_dataset_dict'):
+        # an intake-esm catalog subset, opened through the catalog so its own options apply
+        datasets = source.to_dataset_dict(xarray_open_kwargs=kwargs, progressbar=False)
+        if len(datasets) != 1:
+            raise ValueError(
+                f'an intake-esm catalog entry must hold exactly one dataset, not {len(datasets)}'
+            )
+        return next(iter(datasets.values()))
+
+    if _is_zarr(source):
+        # consolidated=None uses the consolidated metadata if the store has it
+        kwargs = {name: value for name, value in kwargs.items() if name != 'engine'}
+        return xr.open_zarr(source, consolidated=None, **kwargs)
+
+    return xr.open_dataset(source, **kwargs)
+
+
+def _auto_chunks(ds, varnames, aggregate_dims=None):
+    """
+    Chooses dask chunks for the variables of interest of a dataset: the chunks are multiples of the on-disk
+    chunks, the aggregate dimensions are not split, and the other dimensions are grown (innermost first, as
+    those are contiguous on disk) until a chunk holds about dask's 'array.chunk-size' bytes
+    """
+    target_bytes = dask.utils.parse_bytes(dask.config.get('array.chunk-size'))
+    if aggregate_dims is None:
+        aggregate_dims = []
+
+    chunks = {}
+    for varname in varnames:
+        if varname not in ds.variables:
+            continue
+        var = ds[varname]
+        # contiguous variables have no chunksizes, and any chunking is aligned to them
+        disk_chunks = (
+            var.encoding.get('chunksizes') or var.encoding.get('chunks') or (1,) * var.ndim
+        )
+        disk_chunks = dict(zip(var.dims, disk_chunks))
+
+        var_chunks = {
+            dim: var.sizes[dim] if dim in aggregate_dims else disk_chunks[dim] for dim in var.dims
+        }
+        target_size = max(target_bytes // var.dtype.itemsize, 1)
+        for dim in reversed(var.dims):
+            if dim in aggregate_dims:
+                continue
+            others = int(np.prod([size for d, size in var_chunks.items() if d != dim]))
+            n_disk_chunks = max(target_size // others // disk_chunks[dim], 1)
+            var_chunks[dim] = min(n_disk_chunks * disk_chunks[dim], var.sizes[dim])
+
+        for dim, size in var_chunks.items():
+            chunks[dim] = min(chunks.get(dim, size), size)
+
+    return chunks
+
+
+def _close_all(closers):
+    for closer in closers:
+        if closer is not None:
+            closer()
+
+
+class ComputeCounter(Callback):
+    """
+    Counts the dask graphs computed while it is active, e.g. to check how many times a plot computes its data:
+
+        with ldcpy.ComputeCounter() as counter:
+            ldcpy.plot(ds, 'TS', 'mean', 'orig')
+        print(counter.computes)
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.computes = 0
+
+    def _start(self, dsk):
+        self.computes += 1
+
+
 def print_stats(ds, varname, set1, set2, time=0, sig_dig=4):
     """
     Print error summary statistics of two DataArrays
@@ -90,67 +422,64 @@ def print_stats(ds, varname, set1, set2, time=0, sig_dig=4):
 
     import json
 
-    ds0_metrics = DatasetMetrics(ds[varname].sel(collection=set1).isel(time=time), ['lat', 'lon'])
-    ds1_metrics = DatasetMetrics(ds[varname].sel(collection=set2).isel(time=time), ['lat', 'lon'])
-    d_metrics = DatasetMetrics(
-        ds[varname].sel(collection=set1).isel(time=time)
-        - ds[varname].sel(collection=set2).isel(time=time),
-        ['lat', 'lon'],
-    )
-    diff_metrics = DiffMetrics(
-        ds[varname].sel(collection=set1).isel(time=time),
-        ds[varname].sel(collection=set2).isel(time=time),
-        ['lat', 'lon'],
-    )
+    da_set1 = ds[varname].sel(collection=set1).isel(time=time)
+    da_set2 = ds[varname].sel(collection=set2).isel(time=time)
+    ds0_metrics = DatasetMetrics(da_set1, ['lat', 'lon'])
+    ds1_metrics = DatasetMetrics(da_set2, ['lat', 'lon'])
+    d_metrics = DatasetMetrics(da_set1 - da_set2, ['lat', 'lon'])
+    diff_metrics = DiffMetrics(da_set1, da_set2, ['lat', 'lon'])
 
     output = {}
 
     output['skip1'] = 0
 
-    output['mean set1'] = ds0_metrics.get_metric('mean').values
-    output['mean set2'] = ds1_metrics.get_metric('mean').values
-    output['mean diff'] = d_metrics.get_metric('mean').values
+    output['mean set1'] = ds0_metrics.get_metric('mean')
+    output['mean set2'] = ds1_metrics.get_metric('mean')
+    output['mean diff'] = d_metrics.get_metric('mean')
 
     output['skip2'] = 0
 
-    output['variance set1'] = ds0_metrics.get_metric('variance').values
-    output['variance set2'] = ds1_metrics.get_metric('variance').values
+    output['variance set1'] = ds0_metrics.get_metric('variance')
+    output['variance set2'] = ds1_metrics.get_metric('variance')
 
     output['skip3'] = 0
 
-    output['standard deviation set1'] = ds0_metrics.get_metric('std').values
-    output['standard deviation set2'] = ds1_metrics.get_metric('std').values
+    output['standard deviation set1'] = ds0_metrics.get_metric('std')
+    output['standard deviation set2'] = ds1_metrics.get_metric('std')
 
     output['skip4'] = 0
 
-    # output['dynamic range set1'] = ds0_metrics.get_metric('range').values
-    # output['dynamic range set2'] = ds1_metrics.get_metric('range').values
+    # output['dynamic range set1'] = ds0_metrics.get_metric('range')
+    # output['dynamic range set2'] = ds1_metrics.get_metric('range')
 
     # output['skip5'] = 0xs
 
-    output['max value set1'] = ds0_metrics.get_metric('max_val').values
-    output['max value set2'] = ds1_metrics.get_metric('max_val').values
-    output['min value set1'] = ds0_metrics.get_metric('min_val').values
-    output['min value set2'] = ds1_metrics.get_metric('min_val').values
+    output['max value set1'] = ds0_metrics.get_metric('max_val')
+    output['max value set2'] = ds1_metrics.get_metric('max_val')
+    output['min value set1'] = ds0_metrics.get_metric('min_val')
+    output['min value set2'] = ds1_metrics.get_metric('min_val')
 
     output['skip55'] = 0
 
-    output['max abs diff'] = d_metrics.get_metric('max_abs').values
-    output['min abs diff'] = d_metrics.get_metric('min_abs').values
-    output['mean abs diff'] = d_metrics.get_metric('mean_abs').values
+    output['max abs diff'] = d_metrics.get_metric('max_abs')
+    output['min abs diff'] = d_metrics.get_metric('min_abs')
+    output['mean abs diff'] = d_metrics.get_metric('mean_abs')
 
-    output['mean squared diff'] = d_metrics.get_metric('mean_squared').values
-    output['root mean squared diff'] = d_metrics.get_metric('rms').values
+    output['mean squared diff'] = d_metrics.get_metric('mean_squared')
+    output['root mean squared diff'] = d_metrics.get_metric('rms')
 
-    output['normalized root mean squared diff'] = diff_metrics.get_diff_metric('n_rms').values
-    output['normalized max pointwise error'] = diff_metrics.get_diff_metric('n_emax').values
+    output['normalized root mean squared diff'] = diff_metrics.get_diff_metric('n_rms')
+    output['normalized max pointwise error'] = diff_metrics.get_diff_metric('n_emax')
     output['pearson correlation coefficient'] = diff_metrics.get_diff_metric(
         'pearson_correlation_coefficient'
-    ).values
+    )
     output['ks p-value'] = diff_metrics.get_diff_metric('ks_p_value')
     tmp = 'spatial relative error(% > ' + str(ds0_metrics.get_metric('spre_tol')) + ')'
     output[tmp] = diff_metrics.get_diff_metric('spatial_rel_error')
 
+    # compute every metric in a single pass, so work shared between them is only done once
+    (output,) = dask.compute(output)
+
     for key, value in output.items():
         if key[:4] != 'skip':
             print(f'{key}: {value:.{sig_dig}e}')
@@ -161,29 +490,168 @@ def print_stats(ds, varname, set1, set2, time=0, sig_dig=4):
 #    print(json.dumps(output, indent=4, separators=(',', ': '),))
 
 
+# the names get_diff_metric accepts; compare_all computes any other metric on the difference of the collections
+_DIFF_METRICS = frozenset(
+    [
+        'pearson_correlation_coefficient',
+        'covariance',
+        'ks_p_value',
+        'ks_statistic',
+        'n_rms',
+        'n_emax',
+        'spatial_rel_error',
+    ]
+)
+
+
+def compare_all(ds, varnames, baseline, candidates, metrics, scheduler=None):
+    """
+    Compare several collections to a baseline collection for several variables, computing every
+    (variable, candidate, metric) job together in a single dask graph
+
+    Parameters:
+    ===========
+    ds -- xarray.Dataset
+        an xarray dataset containing multiple netCDF files concatenated across a 'collection' dimension
+    varnames -- list <string>
+        the variables to compare
+    baseline -- string
+        the collection label of the "control" data
+    candidates -- list <string>
+        the collection labels of the data to compare to the baseline
+    metrics -- list <string>
+        the metrics to compute, each aggregated over every dimension of the variable. Names of DiffMetrics metrics
+        (e.g. 'pearson_correlation_coefficient', 'n_rms') compare the candidate to the baseline, and names of
+        DatasetMetrics metrics (e.g. 'max_abs', 'rms') are computed on the difference baseline - candidate.
+
+    Keyword Arguments:
+    ==================
+    scheduler -- string or dask.distributed.Client (default None)
+        the dask scheduler that runs the jobs, e.g. 'processes' for a local process pool or the Client of a
+        dask cluster. By default the current dask scheduler is used.
+
+    Returns
+    =======
+    out -- pandas.DataFrame
+        a table with one row per job and the columns 'variable', 'collection', 'metric' and 'value'
+    """
+    config = {} if scheduler is None else {'scheduler': scheduler}
+    with dask.config.set(config):
+        jobs = []
+        for varname in varnames:
+            # the baseline subset is the same graph for every candidate, so it is only read once
+            da_baseline = ds[varname].sel(collection=baseline)
+            agg_dims = list(da_baseline.dims)
+            for candidate in candidates:
+                da_candidate = ds[varname].sel(collection=candidate)
+                diff_metrics = DiffMetrics(da_baseline, da_candidate, agg_dims)
+                error_metrics = DatasetMetrics(da_baseline - da_candidate, agg_dims)
+                for metric in metrics:
+                    if metric in _DIFF_METRICS:
+                        value = diff_metrics.get_diff_metric(metric)
+                    else:
+                        value = error_metrics.get_metric(metric)
+                    jobs.append((varname, candidate, metric, value))
+
+        values = dask.compute(*[value for *_, value in jobs])
+
+    rows = []
+    for (varname, candidate, metric, _), value in zip(jobs, values):
+        if np.size(value) != 1:
+            raise ValueError(f'metric {metric} does not reduce to a single value')
+        rows.append((varname, candidate, metric, float(np.asarray(value))))
+
+    return pd.DataFrame(rows, columns=['variable', 'collection', 'metric', 'value'])
+
+
+def subset_points(ds, lats, lons):
+    """
+    Get the grid points nearest to each of the given locations, gathered with a single indexing operation along
+    a new 'point' dimension
+
+    Parameters:
+    ===========
+    ds -- xarray.DataArray or xarray.Dataset
+        data on a regular lat/lon grid, or on an unstructured 'ncol' grid with 'lat' and 'lon' coordinates
+    lats -- list <float>
+        the latitudes of the locations
+    lons -- list <float>
+        the longitudes of the locations in degrees east (either in [-180, 180) or [0, 360))
+
+    Returns
+    =======
+    out -- xarray.DataArray or xarray.Dataset
+        the data at the nearest grid point of each location
+    """
+    lats = np.atleast_1d(np.asarray(lats, dtype=np.float64))
+    lons = np.atleast_1d(np.asarray(lons, dtype=np.float64))
+    return ds.isel(_spatial_index(ds).nearest(lats, lons))
+
+
+def subset_box(ds, lat_min, lat_max, lon_min, lon_max):
+    """
+    Get the grid points inside a latitude/longitude box
+
+    Parameters:
+    ===========
+    ds -- xarray.DataArray or xarray.Dataset
+        data on a regular lat/lon grid, or on an unstructured 'ncol' grid with 'lat' and 'lon' coordinates
+    lat_min, lat_max -- float
+        the latitude range of the box (included)
+    lon_min, lon_max -- float
+        the longitude range of the box in degrees east (included). The box crosses the dateline if lon_min is
+        east of lon_max, e.g. lon_min=170 and lon_max=-170.
+
+    Returns
+    =======
+    out -- xarray.DataArray or xarray.Dataset
+        the data inside the box (a lat/lon subgrid for regular grids)
+    """
+    return ds.isel(_spatial_index(ds).box(lat_min, lat_max, lon_min, lon_max))
+
+
 def subset_data(ds, subset, lat=None, lon=None, lev=0, start=None, end=None):
     """
     Get a subset of the given dataArray, returns a dataArray
+
+    Time subsets ('winter', 'spring', 'summer', 'autumn', or a list of month numbers such as [6, 7, 8]) are
+    selected with the integer positions of their times, so no mask of the data is built and only the selected
+    times are copied (lazily for dask-backed data). start and end are either time indices or dates (e.g.
+    '2000-01-15').
     """
     ds_subset = ds
 
-    ds_subset = ds_subset.isel(time=slice(start, end))
+    time_slice = slice(start, end)
+    if isinstance(start, str) or isinstance(end, str):
+        time_slice = ds.indexes['time'].slice_indexer(start, end)
+
+    if isinstance(subset, str):
+        months = _SEASON_MONTHS.get(subset)
+    elif subset is not None:
+        months = list(subset)
+    else:
+        months = None
 
-    if subset == 'winter':
-        ds_subset = ds_subset.where(ds.time.dt.season == 'DJF', drop=True)
-    elif subset == 'spring':
-        ds_subset = ds_subset.where(ds.time.dt.season == 'MAM', drop=True)
-    elif subset == 'summer':
-        ds_subset = ds_subset.where(ds.time.dt.season == 'JJA', drop=True)
-    elif subset == 'autumn':
-        ds_subset = ds_subset.where(ds.time.dt.season == 'SON', drop=True)
+    if months is not None:
+        positions = np.arange(ds.sizes['time'])[time_slice]
+        positions = positions[np.isin(ds.indexes['time'][time_slice].month, months)]
+        ds_subset = ds_subset.isel(time=positions)
+    else:
+        ds_subset = ds_subset.isel(time=time_slice)
 
-    elif subset == 'first5':
+    if subset == 'first5':
         ds_subset = ds_subset.isel(time=slice(None, 5))
 
     if 'lev' in ds_subset.dims:
         ds_subset = ds_subset.isel(lev=lev)
 
+    if 'ncol' in ds_subset.dims and (lat is not None or lon is not None):
+        if lat is None or lon is None:
+            raise ValueError('both lat and lon are needed to subset an unstructured grid')
+        # the nearest grid cell, keeping a ncol dimension of size 1
+        ds_subset = subset_points(ds_subset, [lat], [lon + 180]).rename({'point': 'ncol'})
+        return ds_subset
+
     if lat is not None:
         ds_subset = ds_subset.sel(lat=lat, method='nearest')
         ds_subset = ds_subset.expand_dims('lat')
@@ -193,3 +661,87 @@ def subset_data(ds, subset, lat=None, lon=None, lev=0, start=None, end=None):
         ds_subset = ds_subset.expand_dims('lon')
 
     return ds_subset
+
+
+# The months of each season subset
+_SEASON_MONTHS = {
+    'winter': [12, 1, 2],
+    'spring': [3, 4, 5],
+    'summer': [6, 7, 8],
+    'autumn': [9, 10, 11],
+}
+
+
+class _SpatialIndex(object):
+    """
+    Nearest-point and bounding-box lookups on the horizontal grid of a dataset. Regular grids are searched along
+    each axis, and unstructured grids with a KD-tree of the grid points on the unit sphere.
+    """
+
+    def __init__(self, lat, lon, dim=None):
+        self._lat = np.asarray(lat, dtype=np.float64)
+        self._lon = np.asarray(lon, dtype=np.float64) % 360
+        # the unstructured grid dimension, or None for a regular grid
+        self._dim = dim
+        if dim is not None:
+            self._tree = cKDTree(_unit_vectors(self._lat, self._lon))
+
+    def nearest(self, lats, lons):
+        if self._dim is not None:
+            _, positions = self._tree.query(_unit_vectors(lats, lons % 360))
+            return {self._dim: xr.DataArray(positions, dims='point')}
+
+        lat_positions = np.abs(lats[:, np.newaxis] - self._lat).argmin(axis=1)
+        lon_distance = np.abs((lons[:, np.newaxis] - self._lon + 180) % 360 - 180)
+        lon_positions = lon_distance.argmin(axis=1)
+        return {
+            'lat': xr.DataArray(lat_positions, dims='point'),
+            'lon': xr.DataArray(lon_positions, dims='point'),
+        }
+
+    def box(self, lat_min, lat_max, lon_min, lon_max):
+        lat_in_box = (self._lat >= lat_min) & (self._lat <= lat_max)
+        if lon_max - lon_min >= 360:
+            lon_in_box = np.ones(self._lon.shape, dtype=bool)
+        else:
+            lon_in_box = (self._lon - lon_min) % 360 <= (lon_max - lon_min) % 360
+
+        if self._dim is not None:
+            return {self._dim: np.flatnonzero(lat_in_box & lon_in_box)}
+        # longitudes are ordered from the west edge of the box, so a box across the 0 meridian stays contiguous
+        lon_positions = np.flatnonzero(lon_in_box)
+        lon_positions = lon_positions[
+            np.argsort((self._lon[lon_positions] - lon_min) % 360, kind='stable')
+        ]
+        return {'lat': np.flatnonzero(lat_in_box), 'lon': lon_positions}
+
+
+# Spatial indexes of recently subset grids, keyed by a checksum of their coordinates
+_spatial_index_cache = {}
+_SPATIAL_INDEX_CACHE_SIZE = 8
+
+
+def _spatial_index(ds):
+    """
+    The spatial index of the grid of a dataset, built once per grid
+    """
+    variables = ds.variables if isinstance(ds, xr.Dataset) else ds.coords
+    if 'lat' in ds.dims and 'lon' in ds.dims:
+        dim = None
+    elif 'ncol' in ds.dims and 'lat' in variables and 'lon' in variables:
+        dim = 'ncol'
+    else:
+        raise ValueError(
+            'the data must have lat and lon dimensions, or ncol with lat and lon coordinates'
+        )
+
+    lat = ds['lat'].values
+    lon = ds['lon'].values
+    key = dask.base.tokenize(lat, lon, dim)
+    index = _spatial_index_cache.get(key)
+    if index is None:
+        if len(_spatial_index_cache) >= _SPATIAL_INDEX_CACHE_SIZE:
+            _spatial_index_cache.pop(next(iter(_spatial_index_cache)))
+        index = _SpatialIndex(lat, lon, dim)
+        _spatial_index_cache[key] = index
+    return index
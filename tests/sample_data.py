@@ -0,0 +1,91 @@
+"""
+Sample files for the tests. The CAM-FV files in data/ are used where they are shipped, and the others (the
+original PRECT and TS series and their compressed versions) are stood in for by small files derived from them,
+written to a temporary directory when this module is first imported.
+"""
+
+import os
+import tempfile
+
+import numpy as np
+import xarray as xr
+
+PRECT_FILE = 'data/cam-fv/zfp1e-7.PRECT.60days.nc'
+T_FILE = 'data/cam-fv/c.fpzip.cam-fv.T.3months.nc'
+CAM_SE_TS_FILES = ['data/cam-se/ihesp14.TS.12mon.nc', 'data/cam-se/d.sz1e-1.ihesp14.TS.12mon.nc']
+
+_directory = tempfile.TemporaryDirectory()
+
+
+def _write(ds, name):
+    path = os.path.join(_directory.name, name)
+    ds.to_netcdf(path)
+    return path
+
+
+def _rounded(ds, varname, step):
+    """
+    ds with the values of varname rounded to multiples of step, a stand-in for lossy compression
+    """
+    rounded = ds.copy()
+    rounded[varname] = (np.round(ds[varname] / step) * step).astype(ds[varname].dtype)
+    rounded[varname].attrs = ds[varname].attrs
+    return rounded
+
+
+def _prect_files():
+    """
+    The PRECT file of data/ as the original, with two versions rounded to 1e-7 and 1e-9 m/s
+    """
+    with xr.open_dataset(PRECT_FILE) as prect:
+        prect = prect.load()
+    return [
+        PRECT_FILE,
+        _write(_rounded(prect, 'PRECT', 1e-7), 'recon.PRECT.60days.nc'),
+        _write(_rounded(prect, 'PRECT', 1e-9), 'recon_2.PRECT.60days.nc'),
+    ]
+
+
+def _ts_files():
+    """
+    100 days of a surface temperature on a coarsened CAM-FV grid (the lowest level of the T file of data/, with a
+    seasonal cycle and daily noise), with two versions rounded to 2 K and 0.2 K
+    """
+    with xr.open_dataset(T_FILE) as t:
+        surface = t['T'].isel(time=0, lev=-1).coarsen(lat=4, lon=4, boundary='trim').mean().load()
+        gw = t['gw'].coarsen(lat=4, boundary='trim').sum().load()
+
+    rng = np.random.default_rng(0)
+    days = np.arange(100)
+    cycle = (
+        5
+        * np.sin(2 * np.pi * days / 365)[:, np.newaxis, np.newaxis]
+        * np.sign(surface['lat'].values)[:, np.newaxis]
+    )
+    noise = rng.normal(0, 1, size=(len(days),) + surface.shape)
+    ts = xr.Dataset(
+        {
+            'TS': (
+                ('time', 'lat', 'lon'),
+                (surface.values + cycle + noise).astype(np.float32),
+                {'units': 'K', 'long_name': 'Surface temperature (radiative)'},
+            ),
+            'gw': gw,
+        },
+        coords={
+            'time': ('time', days, {'units': 'days since 1920-01-01', 'calendar': 'noleap'}),
+            'lat': surface['lat'],
+            'lon': surface['lon'],
+        },
+    )
+    ts = xr.decode_cf(ts)
+    return [
+        _write(ts, 'orig.TS.100days.nc'),
+        _write(_rounded(ts, 'TS', 2.0), 'recon.TS.100days.nc'),
+        _write(_rounded(ts, 'TS', 0.2), 'recon2.TS.100days.nc'),
+    ]
+
+
+# the original and two reconstructions of each variable
+PRECT_FILES = _prect_files()
+TS_FILES = _ts_files()
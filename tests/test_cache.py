@@ -0,0 +1,111 @@
+import os
+import tempfile
+from unittest import TestCase, mock
+
+import dask
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+import ldcpy
+from ldcpy.cache import MetricCache
+
+times = pd.date_range('2000-01-01', periods=10)
+lats = [0, 1, 2, 3]
+lons = [0, 1, 2, 3, 4]
+test_data = xr.DataArray(
+    np.arange(-100, 100).reshape(4, 5, 10), coords=[lats, lons, times], dims=['lat', 'lon', 'time']
+)
+
+
+class TestMetricCache(TestCase):
+    def setUp(self) -> None:
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self._cache = MetricCache(self._tmpdir.name)
+
+    def tearDown(self) -> None:
+        self._tmpdir.cleanup()
+
+    @pytest.mark.nonsequential
+    def test_cache_hit(self):
+        em = ldcpy.DatasetMetrics(test_data, ['time'], cache=self._cache)
+        mean = em.get_metric('mean')
+        self.assertTrue(len(os.listdir(self._cache.directory)) == 1)
+
+        # a new object on the same data reads the metric back instead of computing it
+        em2 = ldcpy.DatasetMetrics(test_data, ['time'], cache=self._cache)
+        key = em2._cache_key('mean', 0.5)
+        self.assertTrue(self._cache.get(key) is not None)
+        self.assertTrue(em2.get_metric('mean').equals(mean))
+        self.assertTrue(em2._mean.equals(mean))
+
+    @pytest.mark.nonsequential
+    def test_cache_key(self):
+        key = self._cache.key(test_data, ['time'], 'mean')
+        self.assertTrue(key == self._cache.key(test_data.copy(), ['time'], 'mean'))
+        self.assertTrue(key != self._cache.key(test_data + 1, ['time'], 'mean'))
+        self.assertTrue(key != self._cache.key(test_data, ['lat', 'lon'], 'mean'))
+        self.assertTrue(
+            self._cache.key(test_data, ['time'], 'quantile', q=0.5)
+            != self._cache.key(test_data, ['time'], 'quantile', q=0.9)
+        )
+
+    @pytest.mark.nonsequential
+    def test_cache_tokenizes_once(self):
+        em = ldcpy.DatasetMetrics(test_data, ['time'], cache=self._cache)
+        with mock.patch('dask.base.tokenize', wraps=dask.base.tokenize) as tokenize:
+            for name in ['mean', 'std', 'max_val', 'quantile']:
+                em.get_metric(name)
+        self.assertTrue(tokenize.call_count == 1)
+
+    @pytest.mark.nonsequential
+    def test_cache_skips_full_size_metrics(self):
+        em = ldcpy.DatasetMetrics(test_data, ['time'], cache=self._cache)
+        self.assertTrue('time' in em.get_metric('lag1').dims)
+        self.assertTrue(os.listdir(self._cache.directory) == [])
+
+    @pytest.mark.nonsequential
+    def test_cache_get_metrics(self):
+        em = ldcpy.DatasetMetrics(test_data.chunk({'time': 5}), ['time'], cache=self._cache)
+        em.get_metric('std')
+        metrics = em.get_metrics(['mean', 'std', 'quantile'])
+        self.assertTrue(len(os.listdir(self._cache.directory)) == 3)
+        self.assertTrue(metrics['std'].equals(em.get_metric('std')))
+        self.assertTrue(np.isclose(metrics['quantile'], test_data.quantile(0.5, dim='time')).all())
+
+    @pytest.mark.nonsequential
+    def test_cache_eviction(self):
+        em = ldcpy.DatasetMetrics(test_data, ['time'], cache=self._cache)
+        em.get_metric('mean')
+        size = os.path.getsize(
+            os.path.join(self._cache.directory, os.listdir(self._cache.directory)[0])
+        )
+
+        small_cache = MetricCache(self._cache.directory, max_size=2 * size)
+        em = ldcpy.DatasetMetrics(test_data, ['time'], cache=small_cache)
+        em.get_metric('max_val')
+        em.get_metric('min_val')
+        # the least recently used entry (the mean) is removed
+        self.assertTrue(len(os.listdir(small_cache.directory)) == 2)
+        self.assertTrue(small_cache.get(em._cache_key('mean', 0.5)) is None)
+
+    @pytest.mark.nonsequential
+    def test_cache_clear(self):
+        em = ldcpy.DatasetMetrics(test_data, ['time'], cache=self._cache)
+        em.get_metric('mean')
+        # a temporary file left by a put that was interrupted
+        open(os.path.join(self._cache.directory, 'interrupted.nc.tmp'), 'w').close()
+        self._cache.clear()
+        self.assertTrue(os.listdir(self._cache.directory) == [])
+
+    @pytest.mark.nonsequential
+    def test_default_cache(self):
+        ldcpy.set_cache(self._cache.directory)
+        try:
+            em = ldcpy.DatasetMetrics(test_data, ['time'])
+            em.get_metric('mean')
+            self.assertTrue(len(os.listdir(self._cache.directory)) == 1)
+        finally:
+            ldcpy.set_cache(None)
+        self.assertTrue(ldcpy.cache.get_cache() is None)
@@ -1,12 +1,14 @@
-from unittest import TestCase
+from unittest import TestCase, mock
 
 import numpy as np
 import pandas as pd
 import pytest
 import xarray as xr
+from scipy import stats as ss
 
 import ldcpy
-from ldcpy.metrics import DatasetMetrics, DiffMetrics
+from ldcpy import metrics
+from ldcpy.metrics import DatasetMetrics, DiffMetrics, _chunked_ks_statistic, _in_selected_bins
 
 times = pd.date_range('2000-01-01', periods=10)
 lats = [0, 1, 2, 3]
@@ -816,3 +818,344 @@ class TestErrorMetrics(TestCase):
                 test_diff_metrics.get_diff_metric('n_rms'), np.array(0.00502513), rtol=1e-09
             ).all()
         )
+
+    @pytest.mark.nonsequential
+    def test_fused_moments_memoized(self):
+        em = DatasetMetrics(test_data, ['time'])
+        em.get_metric('mean')
+        self.assertTrue(em._is_memoized('_std') and em._is_memoized('_prob_negative'))
+
+    @pytest.mark.nonsequential
+    def test_fused_moments_chunked(self):
+        em = DatasetMetrics(test_data.chunk({'time': 3, 'lat': 3}), ['time'])
+        for name in [
+            'mean',
+            'std',
+            'variance',
+            'rms',
+            'sum',
+            'min_abs',
+            'max_val',
+            'prob_positive',
+        ]:
+            self.assertTrue(
+                np.isclose(
+                    em.get_metric(name), test_spatial_metrics.get_metric(name), rtol=1e-09
+                ).all()
+            )
+
+    @pytest.mark.nonsequential
+    def test_get_metrics(self):
+        em = DatasetMetrics(test_data.chunk({'time': 5}), ['time', 'lat', 'lon'])
+        metrics = em.get_metrics(['mean', 'variance', 'max_abs', 'quantile'])
+        self.assertTrue(isinstance(metrics, xr.Dataset))
+        self.assertTrue(metrics['mean'] == -0.5)
+        self.assertTrue(metrics['variance'] == 3333.25)
+        self.assertTrue(metrics['max_abs'] == 100)
+        self.assertTrue(metrics['quantile'] == -0.5)
+        self.assertTrue(isinstance(em.mean.data, np.ndarray))
+
+    @pytest.mark.nonsequential
+    def test_streaming_metrics(self):
+        sm = ldcpy.StreamingMetrics(['time'])
+        for start in range(0, 10, 3):
+            sm.update(test_data.isel(time=slice(start, start + 3)))
+        self.assertTrue(sm.frame_size == 10)
+        for name in ['mean', 'std', 'variance', 'max_abs', 'min_val', 'prob_negative', 'zscore']:
+            self.assertTrue(
+                np.isclose(
+                    sm.get_metric(name), test_spatial_metrics.get_metric(name), rtol=1e-09
+                ).all()
+            )
+
+    @pytest.mark.nonsequential
+    def test_streaming_metrics_merge(self):
+        sm1 = ldcpy.StreamingMetrics(['time'])
+        sm1.update(test_data.isel(time=slice(0, 4)))
+        sm2 = ldcpy.StreamingMetrics(['time'])
+        sm2.update(test_data.isel(time=slice(4, None)).transpose('time', 'lon', 'lat'))
+        sm1.merge(sm2)
+        self.assertTrue((sm1.get_metric('variance') == 8.25).all())
+
+    @pytest.mark.nonsequential
+    def test_no_upcast(self):
+        data = (test_data / 7).astype(np.float32)
+        em = DatasetMetrics(data, ['time'], upcast=False)
+        em64 = DatasetMetrics(data, ['time'])
+        self.assertTrue(em.get_metric('ds').dtype == np.float32)
+        for name in ['mean', 'std', 'rms', 'max_val', 'ns_con_var', 'quantile']:
+            metric = em.get_metric(name)
+            self.assertTrue(metric.dtype == np.float64)
+            # the float32 differences of neighbors are only as precise as the data
+            rtol = 1e-6 if name == 'ns_con_var' else 1e-12
+            self.assertTrue(np.allclose(metric, em64.get_metric(name), rtol=rtol))
+
+    @pytest.mark.nonsequential
+    def test_no_upcast_copy(self):
+        # two years of days, so the float64 climatology is half the size of the data
+        days = pd.date_range('2000-01-01', periods=730)
+        data = xr.DataArray(
+            np.random.default_rng(0).normal(size=(4, 5, 730)).astype(np.float32),
+            coords=[lats, lons, days],
+            dims=['lat', 'lon', 'time'],
+        )
+        data_2 = data + 1
+        init = xr.Variable.__init__
+        intermediates = []
+
+        def recording_init(variable, *args, **kwargs):
+            init(variable, *args, **kwargs)
+            intermediates.append((variable.dtype, variable.size))
+
+        with mock.patch.object(xr.Variable, '__init__', recording_init):
+            em = DatasetMetrics(data, ['time'], upcast=False)
+            for name in ['ns_con_var', 'ew_con_var', 'quantile', 'lag1', 'corr_lag1']:
+                em.get_metric(name)
+            dm = DiffMetrics(data, data_2, ['time'], upcast=False)
+            for name in ['n_emax', 'n_rms', 'spatial_rel_error']:
+                dm.get_diff_metric(name)
+        # every array the size of the data keeps its precision
+        self.assertTrue(any(size >= data.size for _, size in intermediates))
+        self.assertTrue(
+            all(dtype != np.float64 for dtype, size in intermediates if size >= data.size)
+        )
+
+    @pytest.mark.nonsequential
+    def test_diff_ksp_chunked(self):
+        rng = np.random.default_rng(0)
+        x = np.round(rng.normal(size=5000), 2)
+        y = np.round(rng.normal(0.1, 1.0, size=4000), 2)
+        expected = ss.ks_2samp(x, y).statistic
+        statistic = _chunked_ks_statistic(
+            xr.DataArray(x).chunk(512).data, y, bins=16, max_exact_values=100
+        )
+        self.assertTrue(np.isclose(statistic, expected, rtol=1e-12))
+
+    @pytest.mark.nonsequential
+    def test_diff_ksp_chunked_ties(self):
+        rng = np.random.default_rng(0)
+        # about half of the values are exact zeros, like precipitation
+        x = np.where(rng.random(5000) < 0.5, 0, rng.normal(size=5000))
+        y = np.where(rng.random(4000) < 0.4, 0, rng.normal(size=4000))
+        gathered = []
+
+        def in_selected_bins(block, edges, selected):
+            in_bins = _in_selected_bins(block, edges, selected)
+            gathered.append(in_bins.sum())
+            return in_bins
+
+        with mock.patch('ldcpy.metrics._in_selected_bins', in_selected_bins):
+            statistic = _chunked_ks_statistic(
+                xr.DataArray(x).chunk(512).data, y, bins=16, max_exact_values=100
+            )
+        self.assertTrue(np.isclose(statistic, ss.ks_2samp(x, y).statistic, rtol=1e-12))
+        self.assertTrue(sum(gathered) <= 100)
+
+    @pytest.mark.nonsequential
+    def test_diff_ksp_chunked_upper_bound(self):
+        rng = np.random.default_rng(0)
+        x = rng.normal(size=5000)
+        y = rng.normal(0.1, 1.0, size=4000)
+        with self.assertWarns(RuntimeWarning):
+            statistic = _chunked_ks_statistic(
+                xr.DataArray(x).chunk(512).data, y, bins=4, max_exact_values=100, max_refinements=0
+            )
+        self.assertTrue(statistic >= ss.ks_2samp(x, y).statistic)
+
+    @pytest.mark.nonsequential
+    def test_diff_ks_statistic_spatial(self):
+        dm = DiffMetrics(test_data, test_data_2.chunk({'time': 3}), ['time'])
+        expected = ss.ks_2samp(test_data_2[0, 0], test_data[0, 0]).statistic
+        self.assertTrue(np.isclose(dm.get_diff_metric('ks_statistic'), expected).all())
+
+    @pytest.mark.nonsequential
+    def test_diff_spatial_rel_error(self):
+        self.assertTrue(
+            np.isclose(test_diff_metrics.get_diff_metric('spatial_rel_error'), 100.0, rtol=1e-09)
+        )
+
+    @pytest.mark.nonsequential
+    def test_diff_rel_error_exceedance(self):
+        dm = DiffMetrics(test_data.chunk({'time': 5}), test_data_2, ['time'])
+        exceedance = dm.rel_error_exceedance([1e-4, 0.02], keep_dims=['time'])
+        self.assertTrue(exceedance.dims == ('time', 'tolerance'))
+        self.assertTrue((exceedance.isel(tolerance=0) == 100).all())
+        self.assertTrue(np.isclose(exceedance.isel(tolerance=1).sum(), 495.0, rtol=1e-09))
+
+    @pytest.mark.nonsequential
+    def test_con_var_ncol(self):
+        rng = np.random.default_rng(0)
+        grid = xr.DataArray(
+            rng.normal(size=(3, 4, 36)),
+            coords=[times[:3], [-30.0, -10.0, 10.0, 30.0], np.arange(0.0, 360.0, 10.0)],
+            dims=['time', 'lat', 'lon'],
+        )
+        # the same data on an unstructured grid, with one cell per lat/lon point
+        ncol = grid.stack(ncol=['lat', 'lon']).reset_index('ncol').drop_vars(['lat', 'lon'])
+        ncol = ncol.assign_coords(
+            lat=('ncol', grid['lat'].values.repeat(36)),
+            lon=('ncol', np.tile(grid['lon'].values, 4)),
+        )
+        grid_metrics = DatasetMetrics(grid, ['time'])
+        ncol_metrics = DatasetMetrics(ncol, ['time'])
+
+        ew_con_var = ncol_metrics.get_metric('ew_con_var').values.reshape(4, 36)
+        self.assertTrue(np.allclose(ew_con_var, grid_metrics.get_metric('ew_con_var')))
+        # the northmost cells have no neighbor to the north on the grid
+        ns_con_var = ncol_metrics.get_metric('ns_con_var').values.reshape(4, 36)[:3]
+        self.assertTrue(np.allclose(ns_con_var, grid_metrics.get_metric('ns_con_var')))
+
+    @pytest.mark.nonsequential
+    def test_weighted_metrics(self):
+        weights = xr.DataArray([1.0, 2.0, 3.0, 4.0], coords=[lats], dims=['lat'])
+        em = DatasetMetrics(test_data.chunk({'time': 5}), ['time', 'lat', 'lon'], weights=weights)
+        weighted = test_data.weighted(weights)
+        self.assertTrue(np.isclose(em.mean, weighted.mean(), rtol=1e-09))
+        self.assertTrue(np.isclose(em.variance, weighted.var(), rtol=1e-09))
+        self.assertTrue(np.isclose(em.std, weighted.std(), rtol=1e-09))
+        self.assertTrue(
+            np.isclose(em.mean_abs, abs(test_data).weighted(weights).mean(), rtol=1e-09)
+        )
+        self.assertTrue(np.isclose(em.prob_positive, (test_data > 0).weighted(weights).mean()))
+        # extrema are not weighted
+        self.assertTrue(em.max_val == 99)
+
+        # weights that are the same everywhere do not change anything
+        em = DatasetMetrics(test_data, ['lat', 'lon'], weights=xr.ones_like(weights))
+        self.assertTrue(np.allclose(em.mean, test_time_series_metrics.mean, rtol=1e-09))
+        self.assertTrue(
+            np.allclose(
+                em.root_mean_squared, test_time_series_metrics.root_mean_squared, rtol=1e-09
+            )
+        )
+
+    @pytest.mark.nonsequential
+    def test_weighted_metrics_fused(self):
+        weights = xr.DataArray([1.0, 2.0, 3.0, 4.0], coords=[lats], dims=['lat'])
+        data = test_data.where(test_data % 7 != 0)
+        chunked = data.chunk({'lat': 2, 'time': 3})
+        # the weighted averages come from the fused reduction, not from separate weighted passes
+        with mock.patch.object(xr.DataArray, 'weighted', side_effect=AssertionError):
+            em = DatasetMetrics(chunked, ['time'], weights=weights)
+            metrics = em.get_metrics(['mean', 'variance', 'rms', 'prob_negative'])
+        weighted = data.weighted(weights)
+        self.assertTrue(np.allclose(metrics['mean'], weighted.mean('time'), rtol=1e-09))
+        self.assertTrue(np.allclose(metrics['variance'], weighted.var('time'), rtol=1e-09))
+        rms = np.sqrt(np.square(data).weighted(weights).mean('time'))
+        self.assertTrue(np.allclose(metrics['rms'], rms, rtol=1e-09))
+        prob_negative = (data < 0).weighted(weights).mean('time')
+        self.assertTrue(np.allclose(metrics['prob_negative'], prob_negative))
+
+    @pytest.mark.nonsequential
+    def test_weighted_diff_metrics(self):
+        weights = xr.DataArray([1.0, 2.0, 3.0, 4.0], coords=[lats], dims=['lat'])
+        diff_metrics = DiffMetrics(test_data, test_data_2, ['time', 'lat', 'lon'], weights=weights)
+        n_rms = np.sqrt(((test_data - test_data_2) ** 2).weighted(weights).mean()) / 199
+        self.assertTrue(np.isclose(diff_metrics.normalized_root_mean_squared, n_rms, rtol=1e-09))
+        self.assertTrue(np.isclose(diff_metrics.pearson_correlation_coefficient, 1.0, rtol=1e-09))
+
+    @pytest.mark.nonsequential
+    def test_con_var_chunked(self):
+        em = DatasetMetrics(test_data.chunk({'lat': 3, 'lon': 2, 'time': 4}), ['time'])
+        self.assertTrue(em.get_metric('ns_con_var').equals(test_spatial_metrics.ns_con_var))
+        self.assertTrue(em.get_metric('ew_con_var').equals(test_spatial_metrics.ew_con_var))
+        em = DatasetMetrics(test_data.chunk({'lon': 2}), ['time', 'lat', 'lon'])
+        self.assertTrue(em.ew_con_var == 400)
+
+    @pytest.mark.nonsequential
+    def test_lev_con_var(self):
+        data = xr.DataArray(
+            np.arange(120.0).reshape(3, 2, 4, 5) ** 2,
+            coords=[times[:3], [0, 1], lats, lons],
+            dims=['time', 'lev', 'lat', 'lon'],
+        )
+        lev_con_var = DatasetMetrics(data, ['time']).get_metric('lev_con_var')
+        expected = np.square(data.isel(lev=0) - data.isel(lev=1)).mean('time')
+        self.assertTrue(lev_con_var.dims == ('lev', 'lat', 'lon'))
+        self.assertTrue(np.allclose(lev_con_var.isel(lev=0), expected))
+        with self.assertRaises(ValueError):
+            test_spatial_metrics.lev_con_var
+
+    @pytest.mark.nonsequential
+    def test_autocorrelation(self):
+        data = xr.DataArray(
+            np.random.default_rng(0).random((800, 2, 3)),
+            coords=[pd.date_range('2000-01-01', periods=800), [0, 1], [0, 1, 2]],
+            dims=['time', 'lat', 'lon'],
+        )
+        em = DatasetMetrics(data, ['time'])
+        resid = (data.groupby('time.dayofyear') - data.groupby('time.dayofyear').mean()).values
+        with mock.patch(
+            'ldcpy.metrics._lag_products_kernel', wraps=metrics._lag_products_kernel
+        ) as kernel:
+            autocorrelation = em.autocorrelation(2).compute()
+            em.autocovariance(1).compute()
+        # every lag comes from a single pass over the residuals, which is reused for smaller lags
+        self.assertTrue(kernel.call_count == 1)
+        self.assertTrue(autocorrelation.dims == ('lag', 'lat', 'lon'))
+        for lag in [1, 2]:
+            expected = (resid[:-lag] * resid[lag:]).sum(0) / np.square(resid).sum(0)
+            self.assertTrue(np.allclose(autocorrelation.sel(lag=lag), expected))
+        expected = (resid[:-1] * resid[1:]).sum(0) / resid.shape[0]
+        self.assertTrue(np.allclose(em.autocovariance(1).sel(lag=1), expected))
+        # corr_lag1 is the lag-1 autocorrelation of lag1, the squared lag-1 differences
+        lag1 = np.square(resid[:-1] - resid[1:])
+        expected = (lag1[:-1] * lag1[1:]).sum(0) / np.square(lag1).sum(0)
+        self.assertTrue(np.allclose(em.corr_lag1, expected))
+
+    @pytest.mark.nonsequential
+    def test_quantiles(self):
+        em = DatasetMetrics(test_data.chunk({'time': 3}), ['time'])
+        quantiles = em.quantiles([0.01, 0.5, 0.99])
+        expected = test_data.quantile([0.01, 0.5, 0.99], dim='time')
+        self.assertTrue(quantiles.dims == expected.dims)
+        self.assertTrue(np.allclose(quantiles, expected))
+        # each quantile is only computed once
+        self.assertTrue(em.quantiles(0.5) is em.quantiles(0.5))
+        self.assertTrue(em.get_metric('quantile', 0.99).equals(quantiles.sel(quantile=0.99)))
+
+    @pytest.mark.nonsequential
+    def test_approximate_quantiles(self):
+        data = xr.DataArray(
+            np.random.default_rng(0).normal(size=(40, 4, 5)),
+            coords=[np.arange(40), lats, lons],
+            dims=['time', 'lat', 'lon'],
+        )
+        em = DatasetMetrics(data.chunk({'time': 7, 'lat': 3}), ['time'])
+        quantiles = em.quantiles([0.0, 0.1, 0.5, 1.0], approximate=True, bins=32)
+        expected = data.quantile([0.0, 0.1, 0.5, 1.0], dim='time')
+        bin_width = (em.max_val - em.min_val) / 32
+        self.assertTrue(quantiles.dims == expected.dims)
+        self.assertTrue((abs(quantiles - expected) <= bin_width + 1e-12).all())
+
+    @pytest.mark.nonsequential
+    def test_zscore_fdr(self):
+        rng = np.random.default_rng(0)
+        data = xr.DataArray(
+            rng.normal(size=(30, 20, 10)) + np.where(rng.random((20, 10)) < 0.3, 1.0, 0.0),
+            dims=['time', 'lat', 'lon'],
+        )
+        em = DatasetMetrics(data.chunk({'lat': 5}), ['time'])
+        pvals = np.sort(2 * ss.norm.sf(np.abs(em.zscore.values)).ravel())
+        for fdr in [0.01, 0.05]:
+            em.fdr = fdr
+            bh = np.flatnonzero(pvals <= fdr * np.arange(1, pvals.size + 1) / pvals.size)
+            pval_cutoff = pvals[bh[-1]]
+            self.assertTrue(np.isclose(em.zscore_cutoff[0], ss.norm.ppf(1 - pval_cutoff)))
+            self.assertTrue(
+                em.zscore_percent_significant == 100 * (pvals <= pval_cutoff).sum() / pvals.size
+            )
+        em.fdr = 1e-300
+        self.assertTrue(em.zscore_cutoff == 'na')
+        self.assertTrue(em.zscore_percent_significant == 0)
+
+    @pytest.mark.nonsequential
+    def test_compute_metrics(self):
+        em1 = DatasetMetrics(test_data.chunk({'time': 5}), ['time'])
+        em2 = DatasetMetrics(test_data_2.chunk({'time': 5}), ['time'])
+        with ldcpy.ComputeCounter() as counter:
+            mean_1, mean_2 = ldcpy.compute_metrics([(em1, 'mean'), (em2, 'mean')])
+            em1.get_metric('mean')
+        self.assertTrue(counter.computes == 1)
+        self.assertTrue(mean_1.equals(test_spatial_metrics.mean))
+        self.assertTrue(np.allclose(mean_2 - mean_1, 1))
@@ -1,28 +1,21 @@
+import os
+import tempfile
 from unittest import TestCase
 
+import numpy as np
 import pytest
+import xarray as xr
+from matplotlib import pyplot as plt
 
 import ldcpy
+from ldcpy.plot import _color_range, map_template
 
-ds = ldcpy.open_datasets(
-    ['TS'],
-    [
-        'data/cam-fv/orig.TS.100days.nc',
-        'data/cam-fv/zfp1.0.TS.100days.nc',
-        'data/cam-fv/zfp1e-1.TS.100days.nc',
-    ],
-    ['orig', 'recon', 'recon2'],
-)
-ds2 = ldcpy.open_datasets(
-    ['PRECT'],
-    [
-        'data/cam-fv/orig.PRECT.60days.nc',
-        'data/cam-fv/zfp1e-7.PRECT.60days.nc',
-        'data/cam-fv/zfp1e-11.PRECT.60days.nc',
-    ],
-    ['orig', 'recon', 'recon_2'],
-)
-ds3 = ldcpy.open_datasets(['T'], ['data/cam-fv/cam-fv.T.3months.nc'], ['orig'])
+from .sample_data import CAM_SE_TS_FILES, PRECT_FILES, T_FILE, TS_FILES
+
+ds = ldcpy.open_datasets(['TS'], TS_FILES, ['orig', 'recon', 'recon2'])
+ds2 = ldcpy.open_datasets(['PRECT'], PRECT_FILES, ['orig', 'recon', 'recon_2'])
+ds3 = ldcpy.open_datasets(['T'], [T_FILE], ['orig'])
+ds4 = ldcpy.open_datasets(['TS'], CAM_SE_TS_FILES, ['orig', 'recon'])
 
 
 class TestPlot(TestCase):
@@ -234,3 +227,92 @@ class TestPlot(TestCase):
     def test_mean_time_series(self):
         ldcpy.plot(ds, 'TS', set1='orig', metric='mean', plot_type='time_series')
         self.assertTrue(True)
+
+    @pytest.mark.nonsequential
+    def test_ncol_mean_compare(self):
+        ldcpy.plot(
+            ds4, 'TS', set1='orig', metric='mean', set2='recon', plot_type='spatial_comparison'
+        )
+        self.assertTrue(True)
+
+    @pytest.mark.nonsequential
+    def test_ncol_ns_con_var(self):
+        ldcpy.plot(ds4, 'TS', set1='orig', metric='ns_con_var')
+        self.assertTrue(True)
+
+    @pytest.mark.nonsequential
+    def test_zscore_plot_not_significant(self):
+        # the difference of a set with itself is never significant
+        fig = ldcpy.plot(
+            ds,
+            'TS',
+            set1='orig',
+            set2='orig',
+            metric_type='metric_of_diff',
+            metric='zscore',
+            headless=True,
+        )
+        self.assertTrue('cutoff na' in fig.axes[0].get_title())
+
+    @pytest.mark.nonsequential
+    def test_zscore_computes_once(self):
+        with ldcpy.ComputeCounter() as counter:
+            ldcpy.plot(ds, 'TS', set1='orig', metric='zscore')
+        self.assertTrue(counter.computes == 1)
+
+    @pytest.mark.nonsequential
+    def test_mean_compare_computes_once(self):
+        with ldcpy.ComputeCounter() as counter:
+            ldcpy.plot(
+                ds, 'TS', set1='orig', metric='mean', set2='recon', plot_type='spatial_comparison'
+            )
+        self.assertTrue(counter.computes == 1)
+
+    @pytest.mark.nonsequential
+    def test_plot_grid(self):
+        with ldcpy.ComputeCounter() as counter:
+            ldcpy.plot_grid(ds, 'TS', ['mean', 'std', 'ns_con_var'], ['orig', 'recon', 'recon2'])
+        self.assertTrue(counter.computes == 1)
+
+    @pytest.mark.nonsequential
+    def test_map_template(self):
+        mean = ds['TS'].sel(collection='orig').mean('time')
+        template = map_template(mean)
+        self.assertTrue(map_template(mean) is template)
+        ax = plt.axes(projection=template.projection)
+        mesh = template.draw(ax, mean)
+        template.set_data(mesh, mean * 2)
+        self.assertTrue(np.isclose(mesh.get_array().max(), 2 * float(mean.max())))
+
+    @pytest.mark.nonsequential
+    def test_savefig(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'mean.png')
+            self.assertTrue(ldcpy.plot(ds, 'TS', set1='orig', metric='mean', savefig=path) == path)
+            self.assertTrue(os.path.getsize(path) > 0)
+        fig = ldcpy.plot(ds, 'TS', set1='orig', metric='mean', plot_type='histogram', headless=True)
+        self.assertTrue(len(fig.axes) == 1)
+
+    @pytest.mark.nonsequential
+    def test_render_plots(self):
+        plots = [
+            {'varname': 'TS', 'metric': 'mean', 'set1': 'orig'},
+            {'varname': 'TS', 'metric': 'std', 'set1': 'recon', 'savefig': 'std.png'},
+        ]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = ldcpy.render_plots(ds, plots, tmpdir, max_workers=2)
+            expected = [os.path.join(tmpdir, name) for name in ['TS_mean_orig.png', 'std.png']]
+            self.assertTrue(paths == expected)
+            self.assertTrue(all(os.path.getsize(path) > 0 for path in paths))
+
+    @pytest.mark.nonsequential
+    def test_color_range(self):
+        mean = ds['TS'].sel(collection='orig').mean('time').compute()
+        mean[0, 0] = np.inf
+        mean[0, 1] = np.nan
+        color_min, color_max, all_nan, any_inf = _color_range(mean, mean * 2)
+        finite = mean.where(np.isfinite(mean))
+        self.assertTrue(color_min == float(finite.min()) and color_max == 2 * float(finite.max()))
+        self.assertTrue(not all_nan and any_inf)
+        self.assertTrue(_color_range(mean * np.nan) == (None, None, True, False))
+        self.assertTrue(_color_range(xr.full_like(mean, np.inf)) == (None, None, False, True))
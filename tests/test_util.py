@@ -1,28 +1,18 @@
-from unittest import TestCase
+import os
+import tempfile
+from unittest import TestCase, mock
 
+import numpy as np
 import pytest
+import xarray as xr
 
 import ldcpy
 
-ds = ldcpy.open_datasets(
-    ['TS'],
-    [
-        'data/cam-fv/orig.TS.100days.nc',
-        'data/cam-fv/zfp1.0.TS.100days.nc',
-        'data/cam-fv/zfp1e-1.TS.100days.nc',
-    ],
-    ['orig', 'recon', 'recon2'],
-)
-ds2 = ldcpy.open_datasets(
-    ['PRECT'],
-    [
-        'data/cam-fv/orig.PRECT.60days.nc',
-        'data/cam-fv/zfp1e-7.PRECT.60days.nc',
-        'data/cam-fv/zfp1e-11.PRECT.60days.nc',
-    ],
-    ['orig', 'recon', 'recon_2'],
-)
-ds3 = ldcpy.open_datasets(['T'], ['data/cam-fv/cam-fv.T.3months.nc'], ['orig'])
+from .sample_data import CAM_SE_TS_FILES, PRECT_FILES, T_FILE, TS_FILES
+
+ds = ldcpy.open_datasets(['TS'], TS_FILES, ['orig', 'recon', 'recon2'])
+ds2 = ldcpy.open_datasets(['PRECT'], PRECT_FILES, ['orig', 'recon', 'recon_2'])
+ds3 = ldcpy.open_datasets(['T'], [T_FILE], ['orig'])
 
 
 class TestPlot(TestCase):
@@ -35,3 +25,142 @@ class TestPlot(TestCase):
     def test_print_stats(self):
         ldcpy.print_stats(ds, 'TS', set1='orig', set2='recon')
         self.assertTrue(True)
+
+    @pytest.mark.nonsequential
+    def test_compare_all(self):
+        results = ldcpy.compare_all(ds, ['TS'], 'orig', ['recon', 'recon2'], ['n_rms', 'max_abs'])
+        self.assertTrue(len(results) == 4)
+        self.assertTrue(list(results.columns) == ['variable', 'collection', 'metric', 'value'])
+        with self.assertRaises(ValueError):
+            ldcpy.compare_all(ds, ['TS'], 'orig', ['recon'], ['no_such_metric'])
+
+    @pytest.mark.nonsequential
+    def test_open_datasets_parallel(self):
+        files = PRECT_FILES[:2]
+        ds_parallel = ldcpy.open_datasets(['PRECT'], files, ['orig', 'recon'], parallel=True)
+        self.assertTrue(ds_parallel['PRECT'].sizes['collection'] == 2)
+        self.assertTrue(ds_parallel['PRECT'].identical(ds2['PRECT'].isel(collection=slice(0, 2))))
+        ds_parallel.close()
+
+    @pytest.mark.nonsequential
+    def test_open_datasets_auto_chunks(self):
+        files = PRECT_FILES[:2]
+        ds_spatial = ldcpy.open_datasets(
+            ['PRECT'], files, ['orig', 'recon'], chunks='auto', aggregate_dims=['time']
+        )
+        # the time dimension is not split, so spatial metrics are computed on one chunk per point
+        self.assertTrue(len(ds_spatial['PRECT'].chunksizes['time']) == 1)
+        ds_time_series = ldcpy.open_datasets(
+            ['PRECT'], files, ['orig', 'recon'], chunks='auto', aggregate_dims=['lat', 'lon']
+        )
+        self.assertTrue(len(ds_time_series['PRECT'].chunksizes['lat']) == 1)
+        self.assertTrue(len(ds_time_series['PRECT'].chunksizes['lon']) == 1)
+
+    @pytest.mark.nonsequential
+    def test_open_datasets_conflicts(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            other = xr.open_dataset(PRECT_FILES[1])
+            other['gw'] = other['gw'] * 2
+            path = os.path.join(tmpdir, 'other.PRECT.60days.nc')
+            other.to_netcdf(path)
+            # NetCDF files are combined with the defaults of xarray.open_mfdataset, which check for conflicts
+            with self.assertRaises(ValueError):
+                ldcpy.open_datasets(['PRECT'], [PRECT_FILES[0], path], ['orig', 'other'])
+
+    @pytest.mark.nonsequential
+    def test_open_datasets_zarr(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = os.path.join(tmpdir, 'orig.PRECT.60days.zarr')
+            xr.open_dataset(PRECT_FILES[0]).to_zarr(store, consolidated=True)
+            ds_zarr = ldcpy.open_datasets(
+                ['PRECT'], [store, PRECT_FILES[1]], ['orig', 'recon']
+            )
+            self.assertTrue(
+                ds_zarr['PRECT'].sel(collection='orig').equals(ds2['PRECT'].sel(collection='orig'))
+            )
+            ds_zarr.close()
+
+    @pytest.mark.nonsequential
+    def test_materialize(self):
+        files = PRECT_FILES[:2]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with mock.patch.dict(os.environ, {'XDG_CACHE_HOME': tmpdir}):
+                ds_files = ldcpy.open_datasets(['PRECT'], files, ['orig', 'recon'])
+                store = os.path.join(tmpdir, 'PRECT.zarr')
+                ldcpy.util.materialize(ds_files, store, aggregate_dims=['time'])
+
+                # the same files are now read from the Zarr store
+                ds_store = ldcpy.open_datasets(['PRECT'], files, ['orig', 'recon'])
+                self.assertTrue(ds_store.encoding.get('source', '').startswith(store))
+                self.assertTrue(ds_store['PRECT'].equals(ds_files['PRECT']))
+                self.assertTrue(len(ds_store['PRECT'].chunksizes['time']) == 1)
+
+                # but not with different labels
+                ds_other = ldcpy.open_datasets(['PRECT'], files, ['orig', 'other'])
+                self.assertFalse(ds_other.encoding.get('source', '').startswith(store))
+
+                # or with other arguments for opening the files
+                ds_other = ldcpy.open_datasets(
+                    ['PRECT'], files, ['orig', 'recon'], decode_times=False
+                )
+                self.assertFalse(ds_other.encoding.get('source', '').startswith(store))
+
+    @pytest.mark.nonsequential
+    def test_source_manifest_remote(self):
+        files = ['http://example.com/orig.PRECT.nc', PRECT_FILES[1]]
+        self.assertTrue(ldcpy.util._source_manifest(files) is None)
+
+    @pytest.mark.nonsequential
+    def test_subset_data_months(self):
+        da = ds['TS'].sel(collection='orig')
+        winter = ldcpy.util.subset_data(da, 'winter')
+        self.assertTrue(set(winter.time.dt.month.values) <= {12, 1, 2})
+        self.assertTrue(
+            winter.equals(da.where(da.time.dt.season == 'DJF', drop=True).astype(da.dtype))
+        )
+        months = ldcpy.util.subset_data(da, [1, 3], start=10)
+        self.assertTrue(set(months.time.dt.month.values) <= {1, 3})
+        self.assertTrue(months.time.values[0] >= da.time.values[10])
+
+    @pytest.mark.nonsequential
+    def test_subset_data_dates(self):
+        da = ds['TS'].sel(collection='orig')
+        start, end = [str(t)[:10] for t in da.time.values[[3, 7]]]
+        subset = ldcpy.util.subset_data(da, None, start=start, end=end)
+        self.assertTrue(subset.equals(da.isel(time=slice(3, 8))))
+
+    @pytest.mark.nonsequential
+    def test_subset_points(self):
+        da = ds['TS'].sel(collection='orig')
+        lats = [10.3, -45.0, 80.1]
+        lons = [-120.0, 0.4, 179.9]
+        points = ldcpy.util.subset_points(da, lats, lons)
+        self.assertTrue(points.sizes['point'] == 3)
+        for i in range(3):
+            nearest = da.sel(lat=lats[i], lon=lons[i] % 360, method='nearest')
+            self.assertTrue(points.isel(point=i).equals(nearest))
+
+    @pytest.mark.nonsequential
+    def test_subset_points_ncol(self):
+        ncol_ds = xr.open_dataset(CAM_SE_TS_FILES[0])
+        points = ldcpy.util.subset_points(ncol_ds, [40.0, -40.0], [-105.0, 150.0])
+        self.assertTrue(points['TS'].sizes['point'] == 2)
+        self.assertTrue(np.allclose(points['lat'], [40.0, -40.0], atol=1.0))
+
+    @pytest.mark.nonsequential
+    def test_open_datasets_ncol_close(self):
+        with mock.patch('ldcpy.util._close_all') as close_all:
+            ds_ncol = ldcpy.open_datasets(['TS'], CAM_SE_TS_FILES[:1], ['orig'])
+            self.assertTrue('lat' in ds_ncol['TS'].coords)
+            ds_ncol.close()
+        close_all.assert_called_once()
+
+    @pytest.mark.nonsequential
+    def test_subset_box(self):
+        da = ds['TS'].sel(collection='orig')
+        box = ldcpy.util.subset_box(da, 30, 50, -10, 20)
+        self.assertTrue(((box.lat >= 30) & (box.lat <= 50)).all())
+        lons = (box.lon.values + 10) % 360
+        self.assertTrue((lons <= 30).all())
+        # the longitudes are contiguous across the 0 meridian
+        self.assertTrue((np.diff(lons) > 0).all())